@@ -9,7 +9,8 @@ class Cameo(object):
     ''' Cameo object for the vision framework'''
     def __init__(self):
         self._windowManager = WindowManager('Cameo', self.onKeypress)
-        self._captureManager = CaptureManager(cv2.VideoCapture(0), self._windowManager, True)
+        self._captureManager = CaptureManager(cv2.VideoCapture(0), self._windowManager, True,
+                                              pipelined=True)
 
         self._curves = [None, filters.BGRCrossProcessCurveFilter(), filters.BGRPortraCurveFilter(),
                         filters.BGRProviaCurveFilter(), filters.BGRVelviaCurveFilter()]
@@ -27,6 +28,10 @@ class Cameo(object):
         self._convolution = self._convolutionFilters[self._convolutionIndex]
 
         self._strokeEdges = False
+        self._strokeEdgesFilter = filters.StrokeEdgesFilter()
+
+        self._pipeline = filters.FilterPipeline()
+        self._updatePipeline()
 
         self._faceTracker = FaceTracker()
         self._shouldDrawDebugRects = True
@@ -52,15 +57,8 @@ class Cameo(object):
 
             rects.swapRects(frame,frame,[face.faceRect for face in faces])
 
-            if self._convolution is not None:
-                self._convolution.apply(frame, frame)
-            if self._curveFilter is not None:
-                self._curveFilter.apply(frame, frame)
-            if self._recolor is not None:
-                self._recolor(frame, frame)
-            if self._strokeEdges:
-                filters.strokeEdges(frame, frame)
-            
+            self._pipeline.apply(frame, frame)
+
             filters.deSkew(frame,frame)
 
             if self._shouldDrawDebugRects:
@@ -69,6 +67,15 @@ class Cameo(object):
             self._captureManager.exitFrame()
             self._windowManager.processEvents()
 
+        self._captureManager.close()
+
+    def _updatePipeline(self):
+        ''' Rebuild the filter pipeline from the selected filters'''
+        stages = [self._convolution, self._curveFilter, self._recolor]
+        if self._strokeEdges:
+            stages.append(self._strokeEdgesFilter)
+        self._pipeline.setStages(stages)
+
     def onKeypress(self, keycode):
         ''' Handle keypresses
         Space -> take screenshot
@@ -86,6 +93,11 @@ class Cameo(object):
                 self._captureManager.startWritingVideo('screencast.avi')
             else:
                 self._captureManager.stopWritingVideo()
+                frameWriter = self._captureManager.frameWriter
+                print "Recording stopped: {} frames written, {} queued, {} dropped, " \
+                      "{:.1f}ms mean write latency".format(
+                          frameWriter.framesWritten, frameWriter.framesQueued,
+                          frameWriter.framesDropped, frameWriter.meanWriteLatency * 1000)
         elif rawkey == 0x1b:  # escape
             self._windowManager.destroyWindow()
         
@@ -117,6 +129,7 @@ class Cameo(object):
             else:
                 self._shouldDrawDebugRects = True
 
+        self._updatePipeline()
         statusString="K={},C={},R={},f={}".format(self._convolutionIndex,self._curveIndex,self._recolorIndex,self._strokeEdges)
         self._windowManager.setStatus(statusString)
 
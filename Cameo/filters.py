@@ -38,6 +38,13 @@ class VFuncFilter(object):
     def __init__(self, vFunc=None, dtype=numpy.uint8):
         length = numpy.iinfo(dtype).max + 1
         self._vLookupArray = utils.createLookupArray(vFunc, length)
+        self._dtype = dtype
+
+    @property
+    def bgrLookupArray(self):
+        ''' The V lookup packed for all BGR channels'''
+        return utils.createBGRLookupArray(self._vLookupArray, self._vLookupArray,
+                                          self._vLookupArray, self._dtype)
 
     def apply(self, src, dst):
         ''' Apply the filter with BGR or gray source/dest'''
@@ -54,20 +61,26 @@ class BGRFuncFilter(object):
     ''' A filter class for applying curves to seperate BGR channels'''
     def __init__(self, vFunc=None, bFunc=None, gFunc=None, rFunc=None, dtype=numpy.uint8):
         length = numpy.iinfo(dtype).max + 1
-        self._bLookupArray = utils.createLookupArray(utils.createCompositeFunc(bFunc, vFunc),
-                                                     length)
-        self._gLookupArray = utils.createLookupArray(utils.createCompositeFunc(gFunc, vFunc),
-                                                     length)
-        self._rLookupArray = utils.createLookupArray(utils.createCompositeFunc(rFunc, vFunc),
-                                                     length)
+        # Build the V lookup once and compose it into each channel's lookup
+        vLookupArray = utils.createLookupArray(vFunc, length)
+        self._bLookupArray = utils.createCompositeLookupArray(
+            utils.createLookupArray(bFunc, length), vLookupArray)
+        self._gLookupArray = utils.createCompositeLookupArray(
+            utils.createLookupArray(gFunc, length), vLookupArray)
+        self._rLookupArray = utils.createCompositeLookupArray(
+            utils.createLookupArray(rFunc, length), vLookupArray)
+        self._bgrLookupArray = utils.createBGRLookupArray(self._bLookupArray,
+                                                          self._gLookupArray,
+                                                          self._rLookupArray, dtype)
+
+    @property
+    def bgrLookupArray(self):
+        ''' The combined lengthx1x3 lookup for all BGR channels'''
+        return self._bgrLookupArray
 
     def apply(self, src, dst):
-        ''' Apply the filter to seperate BGR channels'''
-        b, g, r = cv2.split(src)
-        utils.applyLookupArray(self._bLookupArray, b, b)
-        utils.applyLookupArray(self._gLookupArray, g, g)
-        utils.applyLookupArray(self._rLookupArray, r, r)
-        cv2.merge([b, g, r], dst)
+        ''' Apply the filter to all BGR channels in a single pass'''
+        utils.applyBGRLookupArray(self._bgrLookupArray, src, dst)
 
 class BGRCurveFilter(BGRFuncFilter):
     ''' A filter that applies different curves to each BGR channel'''
@@ -120,6 +133,94 @@ class BGRCrossProcessCurveFilter(BGRCurveFilter):
                                 rPoints=[(0, 0), (56, 22), (211, 255), (255, 255)],
                                 dtype=dtype)
 
+# Point operations that can be chained on bands of rows by FilterPipeline
+_pointFuncs = (recolorRC, recolorRGV, recolorCMV)
+
+def _lookupArrayOf(stage):
+    ''' Return the packed 8 bit BGR lookup of a curve stage, or None'''
+    if not isinstance(stage, (VFuncFilter, BGRFuncFilter)):
+        return None
+    lookupArray = stage.bgrLookupArray
+    if lookupArray.dtype != numpy.uint8:
+        return None
+    return lookupArray
+
+class FilterPipeline(object):
+    ''' An ordered chain of filters applied to BGR frames.
+    Adjacent curve filters are composed into a single lookup, and each run of
+    adjacent point operations (curves, VFuncFilters, recolorRC/RGV/CMV) is
+    applied band by band so the frame only passes through memory once.
+    Spatial filters are applied whole, in order'''
+
+    def __init__(self, stages=None, bandBytes=256*1024):
+        self.bandBytes = bandBytes
+        self._stages = []
+        self._compiledStages = []
+        self.setStages(stages)
+
+    @property
+    def stages(self):
+        ''' The filters the pipeline was built from'''
+        return self._stages
+
+    def setStages(self, stages):
+        ''' Compile an ordered list of stages. A stage is a filter with an
+        apply(src, dst) method, a function(src, dst) or None, which is skipped'''
+        self._stages = [stage for stage in (stages or []) if stage is not None]
+        self._compiledStages = []
+        pointOps = []
+        for stage in self._stages:
+            lookupArray = _lookupArrayOf(stage)
+            if lookupArray is not None:
+                if pointOps and isinstance(pointOps[-1], numpy.ndarray):
+                    pointOps[-1] = utils.createCompositeBGRLookupArray(lookupArray,
+                                                                       pointOps[-1])
+                else:
+                    pointOps.append(lookupArray)
+            elif stage in _pointFuncs:
+                pointOps.append(stage)
+            else:
+                self._addPointOps(pointOps)
+                pointOps = []
+                self._compiledStages.append(getattr(stage, 'apply', stage))
+        self._addPointOps(pointOps)
+
+    def _addPointOps(self, pointOps):
+        if not pointOps:
+            return
+        funcs = []
+        for op in pointOps:
+            if isinstance(op, numpy.ndarray):
+                funcs.append(lambda src, dst, lookupArray=op:
+                             utils.applyBGRLookupArray(lookupArray, src, dst))
+            else:
+                funcs.append(op)
+        if len(funcs) == 1:
+            self._compiledStages.append(funcs[0])
+        else:
+            self._compiledStages.append(lambda src, dst: self._applyBanded(funcs, src, dst))
+
+    def _applyBanded(self, funcs, src, dst):
+        ''' Run a chain of point operations one cache sized band at a time'''
+        rowBytes = src[0].nbytes
+        bandHeight = max(1, self.bandBytes // rowBytes)
+        for y in xrange(0, src.shape[0], bandHeight):
+            srcBand = src[y:y+bandHeight]
+            dstBand = dst[y:y+bandHeight]
+            funcs[0](srcBand, dstBand)
+            for func in funcs[1:]:
+                func(dstBand, dstBand)
+
+    def apply(self, src, dst):
+        ''' Apply every stage in order'''
+        if not self._compiledStages:
+            if dst is not src:
+                dst[:] = src
+            return
+        for stage in self._compiledStages:
+            stage(src, dst)
+            src = dst
+
 def split2d(img, cell_size, flatten=True):
     h, w = img.shape[:2]
     sx, sy = cell_size
@@ -150,17 +251,31 @@ def deSkew(src,dst):
 
 def strokeEdges(src, dst, blurKsize=7, edgeKsize=5):
     '''Function to apply a stroke edges filter to the frame'''
-    if blurKsize >= 3:
-        blurredSrc = cv2.medianBlur(src, blurKsize)
-        graySrc = cv2.cvtColor(blurredSrc, cv2.COLOR_BGR2GRAY)
-    else:
-        graySrc = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
-    cv2.Laplacian(graySrc, cv2.CV_8U, graySrc, ksize=edgeKsize)
-    normalizedInverseAlpha = (1.0/255) * (255-graySrc)
-    channels = cv2.split(src)
-    for channel in channels:
-        channel[:] = channel * normalizedInverseAlpha
-    cv2.merge(channels, dst)
+    StrokeEdgesFilter(blurKsize, edgeKsize).apply(src, dst)
+
+class StrokeEdgesFilter(object):
+    '''A filter that blackens edges, like strokes of a pen.
+    Works in 8 bit throughout and reuses its buffers from frame to frame'''
+    def __init__(self, blurKsize=7, edgeKsize=5):
+        self._blurKsize = blurKsize
+        self._edgeKsize = edgeKsize
+        self._blurredSrc = None
+        self._graySrc = None
+        self._inverseAlpha = None
+
+    def apply(self, src, dst):
+        '''Apply the filter to a BGR source/dest'''
+        if self._blurKsize >= 3:
+            self._blurredSrc = cv2.medianBlur(src, self._blurKsize, self._blurredSrc)
+            self._graySrc = cv2.cvtColor(self._blurredSrc, cv2.COLOR_BGR2GRAY, self._graySrc)
+        else:
+            self._graySrc = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY, self._graySrc)
+        cv2.Laplacian(self._graySrc, cv2.CV_8U, self._graySrc, ksize=self._edgeKsize)
+        # 255 - edges is the inverse alpha scaled to 0..255
+        cv2.bitwise_not(self._graySrc, self._graySrc)
+        self._inverseAlpha = cv2.cvtColor(self._graySrc, cv2.COLOR_GRAY2BGR, self._inverseAlpha)
+        # dst = src * inverseAlpha / 255, rounded, for all channels at once
+        cv2.multiply(src, self._inverseAlpha, dst, 1.0/255)
 
 class VConvolutionFilter(object):
     '''A filter that applies a convolution to V or all of BGR'''
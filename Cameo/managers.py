@@ -1,15 +1,101 @@
 ''' Managers module, contains capture manager and windowmanager classes'''
+import Queue
+import threading
 import time
 import cv2
 import numpy
 
+# What a pipelined CaptureManager does when a stage's queue is full
+DROP_OLDEST = 'dropOldest' # discard the oldest queued frame
+BLOCK = 'block' # wait for the next stage to catch up
+
+# Motion JPEG keeps recordings small enough to be written in real time
+DEFAULT_VIDEO_ENCODING = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')
+
+class FramePool(object):
+    ''' Hands out reusable frames keyed by shape and dtype, so a frame loop
+    can recycle its buffers instead of allocating new arrays every frame.
+    Safe to share between threads'''
+
+    def __init__(self):
+        self._freeFrames = {}
+        self._lock = threading.Lock()
+        self._allocations = long(0)
+        self._allocationsAtFrameStart = long(0)
+        self._allocationsPerFrame = 0
+
+    @property
+    def allocations(self):
+        ''' Total number of frames allocated'''
+        return self._allocations
+
+    @property
+    def allocationsPerFrame(self):
+        ''' Number of frames allocated during the last completed frame'''
+        return self._allocationsPerFrame
+
+    def acquire(self, shape, dtype=numpy.uint8):
+        ''' Return a free frame of the given shape and dtype, allocating one
+        only if none is free'''
+        key = (tuple(shape), numpy.dtype(dtype))
+        with self._lock:
+            freeFrames = self._freeFrames.get(key)
+            if freeFrames:
+                return freeFrames.pop()
+            self._allocations += 1
+        return numpy.empty(shape, dtype)
+
+    def release(self, frame):
+        ''' Return a frame to the pool for reuse'''
+        if frame is None:
+            return
+        key = (frame.shape, frame.dtype)
+        with self._lock:
+            self._freeFrames.setdefault(key, []).append(frame)
+
+    def countAllocation(self):
+        ''' Record a frame that was allocated outside the pool'''
+        with self._lock:
+            self._allocations += 1
+
+    def endFrame(self):
+        ''' Mark the end of a frame for allocationsPerFrame'''
+        with self._lock:
+            self._allocationsPerFrame = self._allocations - self._allocationsAtFrameStart
+            self._allocationsAtFrameStart = self._allocations
 
 class CaptureManager(object):
     ''' Capture manager class'''
-    def __init__(self, capture, previewWindowManager=None, shouldMirrorPreview=False):
+    def __init__(self, capture, previewWindowManager=None, shouldMirrorPreview=False,
+                 pipelined=False, queueSize=2, dropPolicy=DROP_OLDEST,
+                 asyncWriting=False, numWriteBuffers=8,
+                 videoEncoding=DEFAULT_VIDEO_ENCODING, framePool=None):
+        ''' In pipelined mode frames are grabbed on a capture thread and
+        handed to the processing thread by a queue holding at most queueSize
+        frames. In pipelined or asyncWriting mode images and video are written
+        by a FrameWriter with numWriteBuffers frame buffers.
+        Captured frames are retrieved into buffers from framePool, and are
+        only valid until exitFrame returns them to it'''
 
         self.previewWindowManager = previewWindowManager
         self.shouldMirrorPreview = shouldMirrorPreview
+        self.dropPolicy = dropPolicy
+        self._pipelined = pipelined
+        self.videoEncoding = videoEncoding
+        if framePool is None:
+            framePool = FramePool()
+        self._framePool = framePool
+        self._frameShape = None
+        self._previewFrame = None
+        self._captureQueue = Queue.Queue(queueSize)
+        self._captureThread = None
+        self._frameWriter = None
+        if pipelined or asyncWriting:
+            self._frameWriter = FrameWriter(numWriteBuffers, dropPolicy)
+        self._isPipelineRunning = False
+        self._isCaptureFinished = False
+        self._framesDropped = long(0)
+        self._pipelineFps = 0.0
         self._capture = capture
         self._enteredFrame = False
         self._frame = None
@@ -27,8 +113,29 @@ class CaptureManager(object):
     def frame(self):
         ''' returns the current frame'''
         if self._enteredFrame and self._frame is None:
-            _, self._frame = self._capture.retrieve()
-            return self._frame
+            self._frame = self._retrieve()
+        return self._frame
+
+    @property
+    def framePool(self):
+        ''' The pool captured and preview frames are taken from'''
+        return self._framePool
+
+    @property
+    def isPipelined(self):
+        ''' Are capture and file writing done on their own threads'''
+        return self._pipelined
+
+    @property
+    def framesDropped(self):
+        ''' Number of captured frames discarded because the queue was full'''
+        return self._framesDropped
+
+    @property
+    def frameWriter(self):
+        ''' The background FrameWriter, or None if writes are synchronous'''
+        return self._frameWriter
+
     @property
     def isWritingImage(self):
         ''' Do we intent to write an image or not'''
@@ -45,7 +152,9 @@ class CaptureManager(object):
         # check that any previos frame was exited
         assert not self._enteredFrame, 'Previous frame not exited! (enter frame without exit frame'
 
-        if self._capture is not None:
+        if self._pipelined:
+            self._enterPipelinedFrame()
+        elif self._capture is not None:
             self._enteredFrame = self._capture.grab()
 
     def exitFrame(self):
@@ -64,24 +173,36 @@ class CaptureManager(object):
         self._framesElapsed += 1
 
         if self.previewWindowManager is not None:
-            
+            # The window manager draws on the preview so give it a copy
+            if self._previewFrame is None or self._previewFrame.shape != self._frame.shape:
+                self._framePool.release(self._previewFrame)
+                self._previewFrame = self._framePool.acquire(self._frame.shape,
+                                                             self._frame.dtype)
             if self.shouldMirrorPreview:
-                toShow = numpy.fliplr(self._frame).copy()
-                self.previewWindowManager.show(toShow)
+                cv2.flip(self._frame, 1, self._previewFrame)
             else:
-                toShow = self._frame.copy()
-            self.previewWindowManager.show(toShow)
-            toShow=None
+                numpy.copyto(self._previewFrame, self._frame)
+            self.previewWindowManager.show(self._previewFrame)
 
 
-        if self.isWritingImage:
-            cv2.imwrite(self._imageFilename, self._frame)
+        if self._frameWriter is not None:
+            videoWriter = None
+            if self.isWritingVideo:
+                videoWriter = self._getVideoWriter()
+            if self.isWritingImage or videoWriter is not None:
+                self._frameWriter.write(self._frame, self._imageFilename, videoWriter)
             self._imageFilename = None
+        else:
+            if self.isWritingImage:
+                cv2.imwrite(self._imageFilename, self._frame)
+                self._imageFilename = None
 
-        if self.isWritingVideo:
-            self._writeVideoFrame()
+            if self.isWritingVideo:
+                self._writeVideoFrame()
 
-        # fraw to the window if present
+        # The frame writer has its own copy, so the frame can be reused
+        self._framePool.release(self._frame)
+        self._framePool.endFrame()
         self._frame = None
         self._enteredFrame = False
 
@@ -89,8 +210,12 @@ class CaptureManager(object):
         ''' Write the next exited frame to an imagefile'''
         self._imageFilename = filename
 
-    def startWritingVideo(self, filename, encoding=cv2.VideoWriter_fourcc('I', '4', '2', '0')):
-        '''Start writing exited frames to a video file'''
+    def startWritingVideo(self, filename, encoding=None):
+        '''Start writing exited frames to a video file
+        The container is chosen from the filename's extension and the codec
+        defaults to videoEncoding'''
+        if encoding is None:
+            encoding = self.videoEncoding
         self._videoFilename = filename
         self._videoEncoding = encoding
 
@@ -100,22 +225,233 @@ class CaptureManager(object):
         self._videoEncoding = None
         self._videoWriter = None
 
-    def _writeVideoFrame(self):
-        if not self.isWritingVideo:
+    def close(self):
+        ''' Stop the background threads, finishing any queued writes'''
+        if self._isPipelineRunning:
+            self._isPipelineRunning = False
+            self._captureThread.join()
+        if self._frameWriter is not None:
+            self._frameWriter.close()
+
+    def _enterPipelinedFrame(self):
+        ''' Take the next frame from the capture thread'''
+        if self._isCaptureFinished:
+            self._enteredFrame = False
             return
+        if not self._isPipelineRunning:
+            self._startPipeline()
+        self._frame = self._captureQueue.get()
+        if self._frame is None:
+            # The capture thread ran out of frames
+            self._isCaptureFinished = True
+        self._enteredFrame = self._frame is not None
+
+    def _startPipeline(self):
+        # The capture is only used on the capture thread from now on
+        self._pipelineFps = 0.0
+        if self._capture is not None:
+            self._pipelineFps = self._capture.get(cv2.CAP_PROP_FPS)
+        self._isPipelineRunning = True
+        self._captureThread = threading.Thread(target=self._captureLoop)
+        self._captureThread.daemon = True
+        self._captureThread.start()
+
+    def _captureLoop(self):
+        while self._isPipelineRunning:
+            if self._capture is None or not self._capture.grab():
+                break
+            frame = self._retrieve()
+            self._putPipelined(self._captureQueue, frame)
+        # Tell the processing thread that no more frames are coming
+        self._putPipelined(self._captureQueue, None)
+
+    def _putPipelined(self, queue, item):
+        ''' Put an item on the bounded capture queue following the drop policy'''
+        while True:
+            try:
+                if self.dropPolicy == BLOCK:
+                    # Time out now and then so close() is not blocked forever
+                    queue.put(item, timeout=0.1)
+                else:
+                    queue.put_nowait(item)
+                return
+            except Queue.Full:
+                if not self._isPipelineRunning:
+                    return
+                if self.dropPolicy == DROP_OLDEST:
+                    try:
+                        self._framePool.release(queue.get_nowait())
+                        self._framesDropped += 1
+                    except Queue.Empty:
+                        pass
+
+    def _retrieve(self):
+        ''' Retrieve the grabbed frame into a buffer from the frame pool'''
+        frame = None
+        if self._frameShape is not None:
+            frame = self._framePool.acquire(self._frameShape)
+        _, retrievedFrame = self._capture.retrieve(frame)
+        if retrievedFrame is not frame:
+            # The capture allocated a new frame, its size may have changed
+            self._framePool.release(frame)
+            if retrievedFrame is not None:
+                self._framePool.countAllocation()
+                self._frameShape = retrievedFrame.shape
+        return retrievedFrame
+
+    def _getVideoWriter(self):
+        ''' Return the video writer, creating it once the fps is known'''
         if self._videoWriter is None:
-            fps = self._capture.get(cv2.CAP_PROP_FPS)
+            fps = self._captureFps()
             if fps == 0.0:
                 # Captures FPS is unknown so guess
                 if self._framesElapsed < 20:
                     # wait until more frames have beeen captured before estimating
-                    return
+                    return None
                 else:
                     fps = self._fpsEstimate
-            size = (int(self._capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                    int(self._capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
-            self._videoWriter = cv2.VideoWriter(self._videoFilename, self._videoEncoding, fps, size)
-        self._videoWriter.write(self._frame)
+            h, w = self._frame.shape[:2]
+            self._videoWriter = cv2.VideoWriter(self._videoFilename, self._videoEncoding, fps, (w, h))
+        return self._videoWriter
+
+    def _captureFps(self):
+        if self._pipelined:
+            return self._pipelineFps
+        return self._capture.get(cv2.CAP_PROP_FPS)
+
+    def _writeVideoFrame(self):
+        if not self.isWritingVideo:
+            return
+        videoWriter = self._getVideoWriter()
+        if videoWriter is not None:
+            videoWriter.write(self._frame)
+
+
+class FrameWriter(object):
+    ''' Writes frames to image and video files on a background thread.
+    Each frame is copied into one of a ring of pre-allocated buffers, so the
+    caller never waits for the disk and may reuse its frame straight away.
+    When every buffer is in use the drop policy decides whether the oldest
+    queued frame is discarded or the caller waits'''
+
+    def __init__(self, numBuffers=8, dropPolicy=DROP_OLDEST):
+        self.dropPolicy = dropPolicy
+        self._numBuffers = numBuffers
+        self._buffers = []
+        self._freeBuffers = Queue.Queue()
+        self._pending = Queue.Queue()
+        self._thread = None
+
+        self._framesWritten = long(0)
+        self._framesDropped = long(0)
+        self._totalWriteLatency = 0.0
+        self._maxWriteLatency = 0.0
+
+    @property
+    def framesQueued(self):
+        ''' Number of frames waiting to be written'''
+        return self._pending.qsize()
+
+    @property
+    def framesWritten(self):
+        ''' Number of frames written so far'''
+        return self._framesWritten
+
+    @property
+    def framesDropped(self):
+        ''' Number of frames discarded because every buffer was in use'''
+        return self._framesDropped
+
+    @property
+    def meanWriteLatency(self):
+        ''' Mean seconds between a frame being queued and written'''
+        if self._framesWritten == 0:
+            return 0.0
+        return self._totalWriteLatency / self._framesWritten
+
+    @property
+    def maxWriteLatency(self):
+        ''' Longest seconds between a frame being queued and written'''
+        return self._maxWriteLatency
+
+    def write(self, frame, imageFilename=None, videoWriter=None):
+        ''' Queue a frame for an image file and/or a cv2.VideoWriter'''
+        self._allocateBuffers(frame)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writeLoop)
+            self._thread.daemon = True
+            self._thread.start()
+        index = self._acquireBuffer()
+        numpy.copyto(self._buffers[index], frame)
+        self._pending.put((index, imageFilename, videoWriter, time.time()))
+
+    def close(self):
+        ''' Write every queued frame then stop the writer thread'''
+        if self._thread is None:
+            return
+        self._pending.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _allocateBuffers(self, frame):
+        if self._buffers and self._buffers[0].shape == frame.shape and \
+                self._buffers[0].dtype == frame.dtype:
+            return
+        # The frame size changed so let the old buffers drain first
+        self._pending.join()
+        self._buffers = [numpy.empty_like(frame) for _ in xrange(self._numBuffers)]
+        self._freeBuffers = Queue.Queue()
+        for index in xrange(self._numBuffers):
+            self._freeBuffers.put(index)
+
+    def _acquireBuffer(self):
+        try:
+            return self._freeBuffers.get_nowait()
+        except Queue.Empty:
+            pass
+        if self.dropPolicy == DROP_OLDEST:
+            # Reuse the buffer of the oldest frame still waiting to be written,
+            # but never drop a screenshot
+            victim = None
+            with self._pending.mutex:
+                for item in self._pending.queue:
+                    if item is not None and item[1] is None:
+                        victim = item
+                        break
+                if victim is not None:
+                    self._pending.queue.remove(victim)
+            if victim is not None:
+                self._pending.task_done()
+                self._framesDropped += 1
+                return victim[0]
+            # Every buffer is being written right now or holds a screenshot
+        return self._freeBuffers.get()
+
+    def _writeLoop(self):
+        while True:
+            # Write every frame that is already queued in one batch
+            batch = [self._pending.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except Queue.Empty:
+                    break
+            for item in batch:
+                if item is None:
+                    self._pending.task_done()
+                    return
+                index, imageFilename, videoWriter, queuedTime = item
+                frame = self._buffers[index]
+                if imageFilename is not None:
+                    cv2.imwrite(imageFilename, frame)
+                if videoWriter is not None:
+                    videoWriter.write(frame)
+                latency = time.time() - queuedTime
+                self._totalWriteLatency += latency
+                self._maxWriteLatency = max(self._maxWriteLatency, latency)
+                self._framesWritten += 1
+                self._freeBuffers.put(index)
+                self._pending.task_done()
 
 
 class WindowManager(object):
@@ -0,0 +1,49 @@
+''' Benchmark the 8 bit stroke edges filter against the original float one'''
+import timeit
+import cv2
+import numpy
+import filters
+
+def floatStrokeEdges(src, dst, blurKsize=7, edgeKsize=5):
+    '''The original float64 implementation of filters.strokeEdges'''
+    if blurKsize >= 3:
+        blurredSrc = cv2.medianBlur(src, blurKsize)
+        graySrc = cv2.cvtColor(blurredSrc, cv2.COLOR_BGR2GRAY)
+    else:
+        graySrc = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
+    cv2.Laplacian(graySrc, cv2.CV_8U, graySrc, ksize=edgeKsize)
+    normalizedInverseAlpha = (1.0/255) * (255-graySrc)
+    channels = cv2.split(src)
+    for channel in channels:
+        channel[:] = channel * normalizedInverseAlpha
+    cv2.merge(channels, dst)
+
+def main():
+    cameraCapture = cv2.VideoCapture(0)
+    success, frame = cameraCapture.read()
+    if not success:
+        # No camera so use a synthetic 1080p frame with plenty of edges
+        frame = numpy.random.randint(0, 256, (1080, 1920, 3)).astype(numpy.uint8)
+        frame = cv2.GaussianBlur(frame, (9, 9), 0)
+    numRuns = 20
+
+    print "Frame size {}x{}".format(frame.shape[1], frame.shape[0])
+    # The median blur costs the same in both, so also time without it
+    for blurKsize in (7, 0):
+        floatDst = numpy.empty_like(frame)
+        fixedDst = numpy.empty_like(frame)
+        strokeEdgesFilter = filters.StrokeEdgesFilter(blurKsize)
+
+        floatTime = timeit.timeit(lambda: floatStrokeEdges(frame, floatDst, blurKsize),
+                                  number=numRuns)
+        fixedTime = timeit.timeit(lambda: strokeEdgesFilter.apply(frame, fixedDst),
+                                  number=numRuns)
+
+        maxDifference = numpy.abs(floatDst.astype(numpy.int16) - fixedDst).max()
+        print "blurKsize={}".format(blurKsize)
+        print "  float strokeEdges  {:.1f}ms per frame".format(floatTime * 1000 / numRuns)
+        print "  8 bit strokeEdges  {:.1f}ms per frame".format(fixedTime * 1000 / numRuns)
+        print "  Speedup {:.1f}x, max difference {}".format(floatTime / fixedTime, maxDifference)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,20 @@
+from multiprocessing.pool import ThreadPool
+import threading
 import cv2
 import utils
 import rects
 
+# Cascades for the features looked for inside each face
+_featureCascadePaths = {'eye': 'cascades/haarcascade_eye.xml',
+                        'nose': 'cascades/haarcascade_mcs_nose.xml',
+                        'mouth': 'cascades/haarcascade_mcs_mouth.xml'}
+
+def _scaleRect(rect, scale):
+    ''' Return a rect with all of its coordinates multiplied by scale'''
+    if scale == 1.0:
+        return rect
+    return tuple(int(round(value * scale)) for value in rect)
+
 class Face(object):
     '''Data on facial features: face, eyes, nose, mouth.'''
 
@@ -15,16 +28,45 @@ class Face(object):
 class FaceTracker(object):
     ''' A tracker for facial features: face, eyes, nose, mouth'''
 
-    def __init__(self, scaleFactor=1.2, minNeighbors=2, flags=cv2.CASCADE_SCALE_IMAGE):
+    def __init__(self, scaleFactor=1.2, minNeighbors=2, flags=cv2.CASCADE_SCALE_IMAGE,
+                 detectionInterval=1, searchMargin=0.25, numThreads=0,
+                 detectionWidth=None, featureFaceWidth=128):
+        ''' Faces are detected in the whole frame every detectionInterval
+        frames. In between each face is looked for again only in its previous
+        rectangle grown by searchMargin times its size on each side, and a
+        face that is lost there forces a full detection on the next frame.
+        With numThreads > 1 the eye, nose and mouth searches of all faces run
+        concurrently on a pool of that many threads.
+        Frames wider than detectionWidth are scaled down to it for face
+        detection, and features are searched for in each face scaled to
+        featureFaceWidth'''
         self.scaleFactor = scaleFactor
         self.minNeighbors = minNeighbors
         self.flags = flags
+        self.detectionInterval = detectionInterval
+        self.searchMargin = searchMargin
+        self.numThreads = numThreads
+        self.detectionWidth = detectionWidth
+        self.featureFaceWidth = featureFaceWidth
 
         self._faces = []
+        self._framesSinceDetection = 0
+        self._shouldDetect = True
+        # Buffers reused from frame to frame
+        self._grayImage = None
+        self._detectionImage = None
         self._faceClassifier = cv2.CascadeClassifier('cascades/haarcascade_frontalface_alt.xml')
-        self._eyeClassifier = cv2.CascadeClassifier('cascades/haarcascade_eye.xml')
-        self._noseClassifier = cv2.CascadeClassifier('cascades/haarcascade_mcs_nose.xml')
-        self._mouthClassifier = cv2.CascadeClassifier('cascades/haarcascade_mcs_mouth.xml')
+        self._eyeClassifier = cv2.CascadeClassifier(_featureCascadePaths['eye'])
+        self._noseClassifier = cv2.CascadeClassifier(_featureCascadePaths['nose'])
+        self._mouthClassifier = cv2.CascadeClassifier(_featureCascadePaths['mouth'])
+
+        # A cascade can not be used by two threads at once, so pool threads
+        # load their own copies on first use
+        self._threadPool = None
+        self._threadLocal = threading.local()
+        self._threadLocal.classifiers = {'eye': self._eyeClassifier,
+                                         'nose': self._noseClassifier,
+                                         'mouth': self._mouthClassifier}
 
     @property
     def faces(self):
@@ -34,40 +76,142 @@ class FaceTracker(object):
     def update(self, image):
         '''Update the tracked facial features'''
 
-        self._faces=[]
-
         if(utils.isGray(image)):
-            image = cv2.equalizeHist(image)
+            self._grayImage = cv2.equalizeHist(image, self._grayImage)
         else:
-            image = cv2.cvtColor(image,cv2.COLOR_BGR2GRAY)
-            image = cv2.equalizeHist(image,image)
-        
-        minSize = utils.widthHeightDividedBy(image, 8)
-        faceRects = self._faceClassifier.detectMultiScale(image, self.scaleFactor, self.minNeighbors, self.flags, minSize)
+            self._grayImage = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, self._grayImage)
+            cv2.equalizeHist(self._grayImage, self._grayImage)
+        image = self._grayImage
+
+        detectionImage, detectionScale = self._getDetectionImage(image)
+
+        self._framesSinceDetection += 1
+        if self._shouldDetect or \
+                self._framesSinceDetection >= self.detectionInterval:
+            minSize = utils.widthHeightDividedBy(detectionImage, 8)
+            faceRects = self._faceClassifier.detectMultiScale(detectionImage, self.scaleFactor, self.minNeighbors, self.flags, minSize)
+            faceRects = [_scaleRect(faceRect, 1.0 / detectionScale) for faceRect in faceRects]
+            self._framesSinceDetection = 0
+            self._shouldDetect = False
+        else:
+            faceRects = self._trackFaces(detectionImage, detectionScale)
+
+        self._faces=[]
 
-        if faceRects is not None:
-            for faceRect in faceRects:
-                face = Face()
-                face.faceRect = faceRect
-                x, y, w, h = faceRect
+        searches = []
+        for faceRect in faceRects:
+            face = Face()
+            face.faceRect = faceRect
+            self._faces.append(face)
 
+            # Search for features at a resolution normalized to the face size
+            faceImage, faceScale = self._getFaceImage(image, faceRect)
+            h, w = faceImage.shape[:2]
+            faceSearches = [
                 # Look for an eye in the upper left part of the face
-                searchRect = (x+w/7, y, w*2/7, h/2)
-                face.leftEyeRect = self._detectOneObject(self._eyeClassifier, image, searchRect, 64)
-
+                ('leftEyeRect', 'eye', (w/7, 0, w*2/7, h/2)),
                 # Look for an eye in the upper right part of the face
-                searchRect = (x+w*4/7, y, w*2/7, h/2)
-                face.rightEyeRect = self._detectOneObject(self._eyeClassifier, image, searchRect, 64)                
-
+                ('rightEyeRect', 'eye', (w*4/7, 0, w*2/7, h/2)),
                 # Look for an nose in the middle part of the face
-                searchRect = (x+w/4, y+h/4, w/2, h/2)
-                face.noseRect = self._detectOneObject(self._noseClassifier, image, searchRect, 64)                
+                ('noseRect', 'nose', (w/4, h/4, w/2, h/2)),
+                # Look for a mouth in the lower part of the face
+                ('mouthRect', 'mouth', (w/6, h*2/3, w*2/3, h/3))]
+            for attrName, featureName, searchRect in faceSearches:
+                searches.append((face, attrName, faceScale,
+                                 (faceImage, featureName, searchRect)))
+
+        searchArgs = [searchArgs for _, _, _, searchArgs in searches]
+        if self.numThreads > 1:
+            if self._threadPool is None:
+                self._threadPool = ThreadPool(self.numThreads)
+            featureRects = self._threadPool.map(self._detectFeature, searchArgs)
+        else:
+            featureRects = map(self._detectFeature, searchArgs)
+
+        # Both maps keep the order of the searches, so the faces are
+        # assembled the same way whichever is used
+        for (face, attrName, faceScale, _), featureRect in zip(searches, featureRects):
+            if featureRect is not None:
+                # Map the rect from the scaled face back to the frame
+                x, y, w, h = _scaleRect(featureRect, 1.0 / faceScale)
+                featureRect = (face.faceRect[0] + x, face.faceRect[1] + y, w, h)
+            setattr(face, attrName, featureRect)
+
+    def close(self):
+        ''' Stop the feature detection threads, if any'''
+        if self._threadPool is not None:
+            self._threadPool.terminate()
+            self._threadPool = None
+
+    def _detectFeature(self, searchArgs):
+        image, featureName, searchRect = searchArgs
+        classifiers = getattr(self._threadLocal, 'classifiers', None)
+        if classifiers is None:
+            classifiers = dict((name, cv2.CascadeClassifier(path))
+                               for name, path in _featureCascadePaths.iteritems())
+            self._threadLocal.classifiers = classifiers
+        return self._detectOneObject(classifiers[featureName], image, searchRect, 8)
+
+    def _getDetectionImage(self, image):
+        ''' Return the image to detect faces in and its scale relative to image'''
+        h, w = image.shape[:2]
+        if self.detectionWidth is None or w <= self.detectionWidth:
+            return image, 1.0
+        scale = float(self.detectionWidth) / w
+        size = (self.detectionWidth, int(round(h * scale)))
+        self._detectionImage = cv2.resize(image, size, self._detectionImage,
+                                          interpolation=cv2.INTER_AREA)
+        return self._detectionImage, scale
+
+    def _getFaceImage(self, image, faceRect):
+        ''' Return the face scaled to featureFaceWidth and the scale used'''
+        x, y, w, h = faceRect
+        faceImage = image[y:y+h, x:x+w]
+        if self.featureFaceWidth is None or w == self.featureFaceWidth:
+            return faceImage, 1.0
+        scale = float(self.featureFaceWidth) / w
+        size = (self.featureFaceWidth, int(round(h * scale)))
+        if scale < 1.0:
+            interpolation = cv2.INTER_AREA
+        else:
+            interpolation = cv2.INTER_LINEAR
+        return cv2.resize(faceImage, size, interpolation=interpolation), scale
+
+    def _trackFaces(self, detectionImage, detectionScale):
+        ''' Look for each face again near where it was last seen'''
+        faceRects = []
+        for face in self._faces:
+            faceRect = self._redetectFace(detectionImage,
+                                          _scaleRect(face.faceRect, detectionScale))
+            if faceRect is None:
+                # Lost a face so fall back to full detection next frame
+                self._shouldDetect = True
+            else:
+                faceRects.append(_scaleRect(faceRect, 1.0 / detectionScale))
+        return faceRects
+
+    def _redetectFace(self, image, faceRect):
+        x, y, w, h = faceRect
+        imageH, imageW = image.shape[:2]
+        marginX = int(w * self.searchMargin)
+        marginY = int(h * self.searchMargin)
+        x0 = max(0, x - marginX)
+        y0 = max(0, y - marginY)
+        x1 = min(imageW, x + w + marginX)
+        y1 = min(imageH, y + h + marginY)
+
+        # Faces do not change size much between frames
+        minSize = (int(w * 0.7), int(h * 0.7))
+        maxSize = (int(w * 1.4), int(h * 1.4))
+        subImage = image[y0:y1, x0:x1]
+        subRects = self._faceClassifier.detectMultiScale(subImage, self.scaleFactor, self.minNeighbors, self.flags, minSize, maxSize)
 
-                                # Look for an nose in the middle part of the face
-                searchRect = (x+w/6, y+h*2/3, w*2/3, h/3)
-                face.mouthRect = self._detectOneObject(self._mouthClassifier, image, searchRect, 64)                
+        if len(subRects) == 0:
+            return None
 
-                self._faces.append(face)
+        # Keep the candidate closest in size to the previous face
+        subX, subY, subW, subH = min(subRects, key=lambda rect: abs(rect[2] - w))
+        return (x0+subX, y0+subY, subW, subH)
 
     def _detectOneObject(self, classifier, image, rect, imageSizeToMinSizeRatio):
         x, y, w, h = rect
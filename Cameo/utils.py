@@ -18,16 +18,16 @@ def createCurveFunc(points):
     return scipy.interpolate.interp1d(xs, ys, kind, bounds_error=False)
 
 def createLookupArray(func, length=256):
-    ''' Return a lookup for a whole number input function'''
+    ''' Return a lookup for a whole number input function
+    The function is evaluated over the whole domain in one call, so 16 bit
+    (65536 entry) lookups cost no more interpreter time than 8 bit ones'''
 
     if func is None:
         return None
-    lookupArray = numpy.empty(length)
-    i = 0
-    while i < length:
-        func_i = func(i)
-        lookupArray[i] = min(max(0, func_i), length -1)
-        i += 1
+    lookupArray = numpy.asarray(func(numpy.arange(length)), numpy.float64)
+    # Points outside the curve evaluate to nan, treat them as 0
+    lookupArray[numpy.isnan(lookupArray)] = 0
+    numpy.clip(lookupArray, 0, length - 1, lookupArray)
     return lookupArray
 
 def applyLookupArray(lookupArray, src, dst):
@@ -36,14 +36,47 @@ def applyLookupArray(lookupArray, src, dst):
         return
     dst[:] = lookupArray[src]
 
+def createBGRLookupArray(bLookupArray, gLookupArray, rLookupArray, dtype=numpy.uint8):
+    ''' Pack seperate B, G and R lookups into a single lengthx1x3 table
+    Channels without a lookup are mapped to themselves'''
+    length = numpy.iinfo(dtype).max + 1
+    identity = numpy.arange(length)
+    channels = [identity if lookupArray is None else lookupArray
+                for lookupArray in (bLookupArray, gLookupArray, rLookupArray)]
+    return numpy.stack(channels, axis=-1).astype(dtype).reshape(length, 1, 3)
+
+def applyBGRLookupArray(lookupArray, src, dst):
+    ''' Map all channels of a BGR source to a destination in one pass'''
+    if lookupArray.dtype == numpy.uint8 and src.dtype == numpy.uint8:
+        cv2.LUT(src, lookupArray, dst)
+    else:
+        # cv2.LUT only handles 8 bit images so index the table directly
+        dst[:] = lookupArray[src, 0, numpy.arange(3)]
+
+def createCompositeBGRLookupArray(lookupArray0, lookupArray1):
+    ''' Return a packed BGR lookup equivalent to applying lookupArray1 then
+    lookupArray0'''
+    channels = numpy.arange(lookupArray1.shape[-1])
+    return lookupArray0[lookupArray1[:, 0, :], 0, channels].reshape(lookupArray1.shape)
+
 def createCompositeFunc(func0, func1):
-    ''' Return a composite of two functions'''
+    ''' Return a composite of two functions
+    If either function is None the other one is returned'''
     if func0 is None:
-        return
+        return func1
     if func1 is None:
-        return
+        return func0
     return lambda x: func0(func1(x))
 
+def createCompositeLookupArray(lookupArray0, lookupArray1):
+    ''' Return a lookup equivalent to applying lookupArray1 then lookupArray0
+    If either lookup is None the other one is returned'''
+    if lookupArray0 is None:
+        return lookupArray1
+    if lookupArray1 is None:
+        return lookupArray0
+    return lookupArray0[numpy.rint(lookupArray1).astype(numpy.intp)]
+
 def createFlatView(array):
     ''' Return a 1d view of an array of any dimensionality'''
     flatView = array.view()
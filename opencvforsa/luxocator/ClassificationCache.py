@@ -0,0 +1,133 @@
+import hashlib
+import json
+import numpy
+import os
+import sqlite3
+import threading
+import time
+
+
+def imageKey(image, mask=None, prefix=''):
+    # Return a key for the image's shape and pixels, and the mask's if any,
+    # prefixed with a string such as the model version.
+    # MD5 is the fastest of hashlib's digests here, and keys need not
+    # resist deliberate collisions.
+    digest = hashlib.md5(prefix)
+    for array in (image, mask):
+        if array is None:
+            digest.update('|')
+            continue
+        array = numpy.ascontiguousarray(array)
+        digest.update('|%s%s' % (array.shape, array.dtype))
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+class ClassificationCache(object):
+    
+    # A persistent cache of labels and per-label similarities, keyed by
+    # strings such as those from imageKey. The least recently used entries
+    # are evicted to keep at most maxEntries. The cache may be shared by
+    # threads.
+    
+    def __init__(self, path, maxEntries=10000):
+        
+        self._maxEntries = maxEntries
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        
+        dirPath = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirPath):
+            os.makedirs(dirPath)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # Write ahead logging avoids syncing the file on every lookup.
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS classifications ('
+                'key TEXT PRIMARY KEY, label TEXT, similarities TEXT, '
+                'lastUsed REAL)')
+        self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS classificationsLastUsed '
+                'ON classifications (lastUsed)')
+        self._connection.commit()
+        self._numEntries = self._connection.execute(
+                'SELECT COUNT(*) FROM classifications').fetchone()[0]
+    
+    @property
+    def maxEntries(self):
+        return self._maxEntries
+    
+    @property
+    def numEntries(self):
+        return self._numEntries
+    
+    @property
+    def hits(self):
+        return self._hits
+    
+    @property
+    def misses(self):
+        return self._misses
+    
+    @property
+    def evictions(self):
+        return self._evictions
+    
+    def get(self, key):
+        # Return the cached label and dict of similarities by label, or
+        # None if the key is not cached.
+        with self._lock:
+            row = self._connection.execute(
+                    'SELECT label, similarities FROM classifications '
+                    'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._connection.execute(
+                    'UPDATE classifications SET lastUsed = ? WHERE key = ?',
+                    (time.time(), key))
+            self._connection.commit()
+        label, similarities = row
+        return label, json.loads(similarities)
+    
+    def put(self, key, label, similaritiesByLabel):
+        with self._lock:
+            exists = self._connection.execute(
+                    'SELECT 1 FROM classifications WHERE key = ?',
+                    (key,)).fetchone() is not None
+            self._connection.execute(
+                    'INSERT OR REPLACE INTO classifications '
+                    'VALUES (?, ?, ?, ?)',
+                    (key, label, json.dumps(similaritiesByLabel),
+                     time.time()))
+            if not exists:
+                self._numEntries += 1
+            numEvicted = self._numEntries - self._maxEntries
+            if numEvicted > 0:
+                self._connection.execute(
+                        'DELETE FROM classifications WHERE key IN ('
+                        'SELECT key FROM classifications '
+                        'ORDER BY lastUsed LIMIT ?)', (numEvicted,))
+                self._numEntries -= numEvicted
+                self._evictions += numEvicted
+            self._connection.commit()
+    
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM classifications')
+            self._connection.commit()
+            self._numEntries = 0
+    
+    def close(self):
+        with self._lock:
+            self._connection.close()
+    
+    def printStats(self):
+        print 'Classification cache: %d hits, %d misses, %d evictions, ' \
+              '%d of %d entries used' % \
+              (self._hits, self._misses, self._evictions, self._numEntries,
+               self._maxEntries)
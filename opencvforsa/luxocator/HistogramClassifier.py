@@ -1,68 +1,680 @@
+import argparse
+import ClassificationCache
+import csv
+import hashlib
+import json
+import multiprocessing
 import numpy
 from CVForwardCompat import cv2
+import os
 import scipy.io
 import scipy.sparse
+import scipy.spatial
+import shutil
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+# Conversions from BGR to the color spaces that can be histogrammed.
+COLOR_CONVERSIONS = {
+    'BGR': None,
+    'HSV': cv2.COLOR_BGR2HSV,
+    'Lab': cv2.COLOR_BGR2LAB
+}
+
+# Channel ranges in each color space, with exclusive upper bounds.
+COLOR_RANGES = {
+    'BGR': [0, 256] * 3,
+    'HSV': [0, 180, 0, 256, 0, 256],
+    'Lab': [0, 256] * 3
+}
+
+# Names under which the histogram configuration is serialized.
+BINS_PER_CHANNEL_KEY = 'HistogramClassifier_binsPerChannel'
+COLOR_SPACE_KEY = 'HistogramClassifier_colorSpace'
+MAX_PIXELS_KEY = 'HistogramClassifier_maxPixels'
+EMBEDDINGS_KEY = 'HistogramClassifier_embeddings'
+EMBEDDING_LABELS_KEY = 'HistogramClassifier_embeddingLabels'
+
+# A model directory holds a JSON header and the base segment's compiled
+# references as .npy arrays that are memory-mapped on loading. Later
+# additions and label removals are appended as delta segments, each a
+# numbered subdirectory of the deltas directory in the same format.
+# Writers lock a file named after the directory with a .lock suffix.
+MODEL_FORMAT_VERSION = 2
+MODEL_HEADER_FILENAME = 'header.json'
+MODEL_ARRAY_NAMES = ['data', 'indices', 'indptr', 'embeddings']
+MODEL_DELTAS_DIRNAME = 'deltas'
+
+# Windows cannot rename or delete files that are mapped, which compaction
+# and reserialization do, so there the arrays are read into memory.
+MODEL_MMAP_MODE = None if os.name == 'nt' else 'r'
+
+
+def _replaceDirectory(tempPath, path):
+    # Swap a fully written directory into place.
+    if os.path.exists(path):
+        oldPath = path + '.old'
+        if os.path.exists(oldPath):
+            shutil.rmtree(oldPath)
+        os.rename(path, oldPath)
+        os.rename(tempPath, path)
+        shutil.rmtree(oldPath)
+    else:
+        os.rename(tempPath, path)
+
+class _ModelDirectoryLock(object):
+    # An advisory lock that serializes changes to a model directory across
+    # threads and processes. The lock file is beside the directory, since
+    # the directory itself is replaced.
+    
+    def __init__(self, path):
+        self._path = path + '.lock'
+        self._file = None
+    
+    def __enter__(self):
+        self._file = open(self._path, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            return self
+        self._file.seek(0)
+        while True:
+            try:
+                # LK_LOCK gives up after 10 seconds, so keep trying.
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                return self
+            except IOError:
+                pass
+    
+    def __exit__(self, excType, excValue, traceback):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+def _readBaseId(path):
+    # Return the identifier of the model directory's base segment.
+    with open(os.path.join(path, MODEL_HEADER_FILENAME), 'r') as f:
+        return json.load(f).get('baseId')
+
+def _listDeltas(path):
+    # Return the sequence numbers and paths of a model's delta segments,
+    # in order.
+    deltasPath = os.path.join(path, MODEL_DELTAS_DIRNAME)
+    if not os.path.isdir(deltasPath):
+        return []
+    deltas = []
+    for name in os.listdir(deltasPath):
+        if name.isdigit():
+            deltas.append((int(name), os.path.join(deltasPath, name)))
+    return sorted(deltas)
+
+
+class _ReferenceSegment(object):
+    # An immutable block of compiled references. Each reference is a row
+    # of a sparse matrix, grouped by label, with labelOffsets[i] as the
+    # first row of label i. The segment's removed labels hide those
+    # labels' references in all earlier segments.
+    
+    def __init__(self, labels, labelOffsets, referenceMatrix,
+                 embeddingMatrix, removedLabels=()):
+        self.labels = list(labels)
+        self.labelOffsets = numpy.asarray(labelOffsets, numpy.intp)
+        self.referenceMatrix = referenceMatrix
+        self.embeddingMatrix = embeddingMatrix
+        self.removedLabels = frozenset(removedLabels)
+        self.labelCounts = numpy.diff(self.labelOffsets)
+        self.referenceLabelIndices = numpy.repeat(
+                numpy.arange(len(self.labels)), self.labelCounts)
+        # The nearest neighbor index is built when it is first needed.
+        self._embeddingTree = None
+    
+    @property
+    def numReferences(self):
+        return self.referenceMatrix.shape[0]
+    
+    def score(self, queryHists, queryEmbeddings, candidateCount):
+        # Return the summed similarity of each query (row) to each label's
+        # references (column), and the number of references summed.
+        if candidateCount is not None and \
+                candidateCount < self.numReferences:
+            return self._scoreCandidates(queryHists, queryEmbeddings,
+                                         candidateCount)
+        return self._scoreAllReferences(queryHists)
+    
+    def _scoreCandidates(self, queryHists, queryEmbeddings, candidateCount):
+        # Intersect each query only with the references whose embeddings
+        # are nearest to its own.
+        if self._embeddingTree is None:
+            self._embeddingTree = scipy.spatial.cKDTree(self.embeddingMatrix)
+        _, candidates = self._embeddingTree.query(
+                queryEmbeddings, candidateCount)
+        candidates = candidates.reshape(len(queryHists), -1)
+        numLabels = len(self.labels)
+        labelSums = numpy.zeros((len(queryHists), numLabels))
+        labelCounts = numpy.zeros((len(queryHists), numLabels))
+        for i, (queryHist, rows) in enumerate(zip(queryHists, candidates)):
+            candidateMatrix = self.referenceMatrix[rows]
+            intersections = numpy.minimum(
+                    queryHist[candidateMatrix.indices], candidateMatrix.data)
+            # Sum each candidate's segment of the intersection values.
+            totals = numpy.concatenate(
+                    ([0.0], numpy.cumsum(intersections, dtype=numpy.float64)))
+            similarities = totals[candidateMatrix.indptr[1:]] - \
+                           totals[candidateMatrix.indptr[:-1]]
+            labelIndices = self.referenceLabelIndices[rows]
+            labelCounts[i] = numpy.bincount(labelIndices, None, numLabels)
+            labelSums[i] = numpy.bincount(
+                    labelIndices, similarities, numLabels)
+        return labelSums, labelCounts
+    
+    def _scoreAllReferences(self, queryHists):
+        # Intersect every query with all references at once.
+        referenceMatrix = self.referenceMatrix
+        labelCounts = numpy.tile(self.labelCounts, (len(queryHists), 1))
+        if self.numReferences == 0:
+            return numpy.zeros(labelCounts.shape), labelCounts
+        # Only the references' nonzero bins can contribute, so gather the
+        # queries' values at those bins.
+        intersections = numpy.minimum(
+                queryHists[:, referenceMatrix.indices], referenceMatrix.data)
+        # Sum each reference's segment of the intersection values, and
+        # then each label's run of references. No reference or label is
+        # empty, so no run is empty.
+        referenceSimilarities = numpy.add.reduceat(
+                intersections, referenceMatrix.indptr[:-1], 1, numpy.float64)
+        labelSums = numpy.add.reduceat(
+                referenceSimilarities, self.labelOffsets[:-1], 1)
+        return labelSums, labelCounts
+    
+    def save(self, path, header):
+        # Write the segment, and the given header fields, to a temporary
+        # directory and then swap it into place, so that a failed save
+        # leaves any previous segment intact.
+        tempPath = path + '.tmp'
+        if os.path.exists(tempPath):
+            shutil.rmtree(tempPath)
+        self.write(tempPath, header)
+        _replaceDirectory(tempPath, path)
+    
+    def write(self, path, header):
+        # Write the segment and the given header fields to a new directory.
+        referenceMatrix = self.referenceMatrix
+        arrays = {
+            'data': referenceMatrix.data.astype(numpy.float32),
+            'indices': referenceMatrix.indices.astype(numpy.int32),
+            'indptr': referenceMatrix.indptr.astype(numpy.int32),
+            'embeddings': self.embeddingMatrix
+        }
+        os.makedirs(path)
+        for name in MODEL_ARRAY_NAMES:
+            numpy.save(os.path.join(path, name + '.npy'), arrays[name])
+        self.writeHeader(path, header)
+    
+    def writeHeader(self, path, header):
+        # Write or rewrite the header of a segment written to the path.
+        header = dict(header)
+        header['formatVersion'] = MODEL_FORMAT_VERSION
+        header['labels'] = self.labels
+        header['labelOffsets'] = [int(offset) for offset in self.labelOffsets]
+        header['removedLabels'] = sorted(self.removedLabels)
+        with open(os.path.join(path, MODEL_HEADER_FILENAME), 'w') as f:
+            json.dump(header, f, indent=4)
+    
+    @staticmethod
+    def load(path, numBins=None):
+        # Return the segment and its header. Map the arrays instead of
+        # reading them where possible, so that loading takes about the same
+        # time regardless of the segment's size.
+        with open(os.path.join(path, MODEL_HEADER_FILENAME), 'r') as f:
+            header = json.load(f)
+        formatVersion = header['formatVersion']
+        if formatVersion > MODEL_FORMAT_VERSION:
+            raise ValueError('Unsupported model format version: %d' %
+                             formatVersion)
+        if numBins is None:
+            numBins = header['numBins']
+        arrays = {}
+        for name in MODEL_ARRAY_NAMES:
+            arrays[name] = numpy.load(os.path.join(path, name + '.npy'),
+                                      mmap_mode=MODEL_MMAP_MODE)
+        labelOffsets = header['labelOffsets']
+        referenceMatrix = scipy.sparse.csr_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']),
+                shape=(labelOffsets[-1], numBins), copy=False)
+        segment = _ReferenceSegment(
+                header['labels'], labelOffsets, referenceMatrix,
+                arrays['embeddings'], header.get('removedLabels', []))
+        return segment, header
+
+
+class _ModelSnapshot(object):
+    # An immutable view of a model's segments, which classification uses
+    # from start to finish so that concurrent updates do not affect it.
+    
+    def __init__(self, segments):
+        self.segments = tuple(segments)
+        # Find the labels each segment's later segments remove.
+        hiddenLabels = []
+        removedLabels = frozenset()
+        for segment in reversed(self.segments):
+            hiddenLabels.append(removedLabels)
+            removedLabels = removedLabels | segment.removedLabels
+        hiddenLabels.reverse()
+        # Order the visible labels by first appearance, and map each
+        # segment's labels to those columns, or -1 if hidden.
+        self.labels = []
+        columnsByLabel = {}
+        self.segmentColumns = []
+        for segment, hidden in zip(self.segments, hiddenLabels):
+            columns = []
+            for label in segment.labels:
+                if label in hidden:
+                    columns.append(-1)
+                    continue
+                if label not in columnsByLabel:
+                    columnsByLabel[label] = len(self.labels)
+                    self.labels.append(label)
+                columns.append(columnsByLabel[label])
+            self.segmentColumns.append(numpy.array(columns, numpy.intp))
+        self.nnz = sum(segment.referenceMatrix.nnz
+                       for segment in self.segments)
+    
+    def score(self, queryHists, queryEmbeddings, candidateCount):
+        # Return the mean similarity of each query (row) to each visible
+        # label (column), over all segments. With a candidate count, the
+        # mean is over the shortlisted references, or 0 if none were
+        # shortlisted.
+        numLabels = len(self.labels)
+        labelSums = numpy.zeros((len(queryHists), numLabels))
+        labelCounts = numpy.zeros((len(queryHists), numLabels))
+        for segment, columns in zip(self.segments, self.segmentColumns):
+            visible = columns >= 0
+            if not visible.any():
+                continue
+            sums, counts = segment.score(queryHists, queryEmbeddings,
+                                         candidateCount)
+            # A label appears at most once per segment, so its columns are
+            # distinct.
+            labelSums[:, columns[visible]] += sums[:, visible]
+            labelCounts[:, columns[visible]] += counts[:, visible]
+        return labelSums / numpy.maximum(labelCounts, 1)
+    
+    def merge(self, numBins, embeddingSize):
+        # Return one segment with the visible references of all segments.
+        blocks = []
+        embeddingBlocks = []
+        labelOffsets = [0]
+        for label in self.labels:
+            numRows = 0
+            for segment, columns in zip(self.segments, self.segmentColumns):
+                if label not in segment.labels:
+                    continue
+                i = segment.labels.index(label)
+                if columns[i] < 0:
+                    continue
+                start = segment.labelOffsets[i]
+                stop = segment.labelOffsets[i + 1]
+                blocks.append(segment.referenceMatrix[start:stop])
+                embeddingBlocks.append(segment.embeddingMatrix[start:stop])
+                numRows += stop - start
+            labelOffsets.append(labelOffsets[-1] + numRows)
+        if blocks:
+            referenceMatrix = scipy.sparse.vstack(blocks, 'csr')
+            embeddingMatrix = numpy.vstack(embeddingBlocks)
+        else:
+            referenceMatrix = scipy.sparse.csr_matrix(
+                    (0, numBins), dtype=numpy.float32)
+            embeddingMatrix = numpy.empty((0, embeddingSize))
+        return _ReferenceSegment(self.labels, labelOffsets, referenceMatrix,
+                                 embeddingMatrix)
+
 
 class HistogramClassifier(object):
     
-    def __init__(self):
+    def __init__(self, binsPerChannel=256, colorSpace='BGR',
+                 maxPixels=None):
         
         self.verbose = False
         self.minimumSimilarityForPositiveLabel = 0.075
         
-        self._channels = range(3)
-        self._histSize = [256] * 3
-        self._ranges = [0, 255] * 3
+        # If set, only this many references, shortlisted by the nearest
+        # embeddings, are intersected with each query. Higher values trade
+        # speed for recall.
+        self.candidateCount = None
+        
+        # If set, a ClassificationCache that classify and classifyBatch
+        # consult before histogramming and scoring an image.
+        self.cache = None
+        
+        self._setHistConfig(binsPerChannel, colorSpace, maxPixels)
+        
+        # Batch size is chosen so that each batch's dense query histograms
+        # and gathered query values each take at most this many elements.
+        self.maxBatchElements = 2 ** 24
+        
+        # References and label removals not yet saved in a segment.
         self._references = {}
+        self._referenceEmbeddings = {}
+        self._removedLabels = set()
+        
+        # Saved segments, and the model directory and last sequence number
+        # they were loaded from or saved to, if any. Each base segment
+        # written to a model directory gets a new identifier, so that a
+        # base replaced by another instance's compaction can be detected.
+        self._segments = []
+        self._modelPath = None
+        self._modelSequence = 0
+        self._baseId = None
+        
+        # The model's version is its identifier, its sequence number, and
+        # an identifier for its unsaved changes, if any.
+        self._modelId = uuid.uuid4().hex
+        self._pendingId = None
+        
+        # The snapshot that classification uses, rebuilt after updates.
+        self._snapshot = None
+        self._lock = threading.RLock()
+    
+    @property
+    def binsPerChannel(self):
+        return self._binsPerChannel
+    
+    @property
+    def colorSpace(self):
+        return self._colorSpace
     
-    def _createNormalizedHist(self, image, sparse):
+    @property
+    def maxPixels(self):
+        return self._maxPixels
+    
+    @property
+    def modelVersion(self):
+        version = '%s:%d' % (self._modelId, self._modelSequence)
+        if self._pendingId is not None:
+            version += ':' + self._pendingId
+        return version
+    
+    def _setHistConfig(self, binsPerChannel, colorSpace, maxPixels):
+        if colorSpace not in COLOR_CONVERSIONS:
+            raise ValueError('Unsupported color space: %s' % colorSpace)
+        # Images with more pixels than this are subsampled before they are
+        # histogrammed. None means images are histogrammed at full size.
+        self._maxPixels = maxPixels
+        self._binsPerChannel = binsPerChannel
+        self._colorSpace = colorSpace
+        self._channels = range(3)
+        self._histSize = [binsPerChannel] * 3
+        self._ranges = COLOR_RANGES[colorSpace]
+        self._numBins = binsPerChannel ** 3
+        # Embeddings sum the histogram into a grid of at most 4 bins per
+        # channel.
+        self._embeddingBinsPerChannel = max(
+                b for b in (4, 3, 2, 1) if binsPerChannel % b == 0)
+        self._embeddingSize = self._embeddingBinsPerChannel ** 3
+    
+    def _embedHist(self, indices, values):
+        # Reduce a histogram, given by its nonzero bins, to a short vector
+        # for the nearest neighbor index.
+        n = self._binsPerChannel
+        c = self._embeddingBinsPerChannel
+        f = n // c
+        coarseIndices = (indices // (n * n) // f) * c * c + \
+                        (indices // n % n // f) * c + \
+                        (indices % n // f)
+        coarseHist = numpy.bincount(coarseIndices, values, c ** 3)
+        # Euclidean distances between square roots of histograms track
+        # how much the histograms overlap.
+        return numpy.sqrt(coarseHist)
+    
+    def _limitPixels(self, image, mask):
+        # Sample every nth row and column of the image, and the mask if
+        # any, to fit the pixel budget. Unlike resizing, sampling keeps the
+        # pixels' colors and reads only the sampled pixels.
+        if self._maxPixels is None:
+            return image, mask
+        h, w = image.shape[:2]
+        if h * w <= self._maxPixels:
+            return image, mask
+        step = int(numpy.ceil((float(h * w) / self._maxPixels) ** 0.5))
+        # Sampling keeps ceil(h / step) rows and ceil(w / step) columns,
+        # which can exceed the budget.
+        while -(-h // step) * -(-w // step) > self._maxPixels:
+            step += 1
+        image = numpy.ascontiguousarray(image[::step, ::step])
+        if mask is not None:
+            mask = numpy.ascontiguousarray(mask[::step, ::step])
+        return image, mask
+    
+    def _createNormalizedHist(self, image, sparse, mask=None,
+                              limitPixels=True):
+        # Pass limitPixels=False for an image already passed through
+        # _limitPixels.
+        if limitPixels:
+            image, mask = self._limitPixels(image, mask)
+        # Convert the image to the histogram's color space.
+        conversion = COLOR_CONVERSIONS[self._colorSpace]
+        if conversion is not None:
+            image = cv2.cvtColor(image, conversion)
         # Create the histogram.
-        hist = cv2.calcHist([image], self._channels, None,
+        hist = cv2.calcHist([image], self._channels, mask,
                             self._histSize, self._ranges)
         # Normalize the histogram.
         hist[:] = hist * (1.0 / numpy.sum(hist))
         # Convert the histogram to one column for efficient storage.
-        hist = hist.reshape(16777216, 1)
+        hist = hist.reshape(self._numBins, 1)
         if sparse:
             # Convert the histogram to a sparse matrix.
             hist = scipy.sparse.csc_matrix(hist)
         return hist
     
-    def addReference(self, image, label):
-        hist = self._createNormalizedHist(image, True)
-        if label not in self._references:
-            self._references[label] = [hist]
-        else:
-            self._references[label] += [hist]
+    def addReference(self, image, label, mask=None):
+        hist = self._createNormalizedHist(image, True, mask)
+        self._addReferenceHist(hist, label)
+    
+    def _addReferenceHist(self, hist, label):
+        embedding = self._embedHist(hist.indices, hist.data)
+        with self._lock:
+            if label not in self._references:
+                self._references[label] = [hist]
+                self._referenceEmbeddings[label] = [embedding]
+            else:
+                self._references[label] += [hist]
+                self._referenceEmbeddings[label] += [embedding]
+            self._pendingId = uuid.uuid4().hex
+            self._snapshot = None
     
     def addReferenceFromFile(self, path, label):
         image = cv2.imread(path, cv2.CV_LOAD_IMAGE_COLOR)
         self.addReference(image, label)
     
-    def classify(self, queryImage, queryImageName=None):
-        queryHist = self._createNormalizedHist(queryImage, False)
+    def addReferencesFromFiles(self, pathsAndLabels, numProcesses=None,
+                               chunkSize=8):
+        # Decode and histogram the images in a process pool, adding each
+        # sparse histogram as it arrives. Return the number of references
+        # added and the paths of any images that could not be read.
+        pool = multiprocessing.Pool(
+                numProcesses, _initTrainingWorker,
+                (self._binsPerChannel, self._colorSpace, self._maxPixels))
+        numAdded = 0
+        skippedPaths = []
+        startTime = time.time()
+        try:
+            results = pool.imap_unordered(
+                    _createReferenceHistFromFile, pathsAndLabels, chunkSize)
+            for path, label, indices, data in results:
+                if indices is None:
+                    skippedPaths.append(path)
+                    if self.verbose:
+                        print 'Skipped unreadable image: %s' % path
+                    continue
+                hist = scipy.sparse.csc_matrix(
+                        (data, indices, [0, len(indices)]),
+                        shape=(self._numBins, 1))
+                self._addReferenceHist(hist, label)
+                numAdded += 1
+                if self.verbose and numAdded % 1000 == 0:
+                    elapsed = time.time() - startTime
+                    print 'Added %d references (%.1f images/s)' % \
+                            (numAdded, numAdded / elapsed)
+        finally:
+            pool.close()
+            pool.join()
+        return numAdded, skippedPaths
+    
+    def removeLabel(self, label):
+        # Remove the label's references, including those already saved.
+        # References added for the label afterward are kept.
+        with self._lock:
+            self._references.pop(label, None)
+            self._referenceEmbeddings.pop(label, None)
+            self._removedLabels.add(label)
+            self._pendingId = uuid.uuid4().hex
+            self._snapshot = None
+    
+    @property
+    def labels(self):
+        return self._getSnapshot().labels
+    
+    def _compilePendingReferences(self):
+        # Stack every unsaved reference as a row of one sparse matrix,
+        # grouped by label, with labelOffsets[i] as the first row of
+        # label i.
+        labels = list(self._references.keys())
+        referenceHists = []
+        embeddings = []
+        labelOffsets = [0]
+        for label in labels:
+            referenceHists += list(self._references[label])
+            embeddings += list(self._referenceEmbeddings[label])
+            labelOffsets.append(len(referenceHists))
+        if referenceHists:
+            referenceMatrix = scipy.sparse.hstack(
+                    referenceHists, format='csc').T.tocsr()
+            embeddingMatrix = numpy.vstack(embeddings)
+        else:
+            referenceMatrix = scipy.sparse.csr_matrix(
+                    (0, self._numBins), dtype=numpy.float32)
+            embeddingMatrix = numpy.empty((0, self._embeddingSize))
+        return _ReferenceSegment(labels, labelOffsets, referenceMatrix,
+                                 embeddingMatrix, self._removedLabels)
+    
+    def _getSnapshot(self):
+        # Return the snapshot of the saved segments and any unsaved
+        # references and removals.
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None:
+                segments = list(self._segments)
+                if self._references or self._removedLabels:
+                    segments.append(self._compilePendingReferences())
+                self._snapshot = _ModelSnapshot(segments)
+                self._snapshot.version = self.modelVersion
+            return self._snapshot
+    
+    def _scoreHists(self, snapshot, queryHists):
+        # Return the mean similarity of each query (row) to each of the
+        # snapshot's labels (column).
+        queryEmbeddings = None
+        if self.candidateCount is not None:
+            queryEmbeddings = []
+            for queryHist in queryHists:
+                indices = numpy.flatnonzero(queryHist)
+                queryEmbeddings.append(
+                        self._embedHist(indices, queryHist[indices]))
+            queryEmbeddings = numpy.vstack(queryEmbeddings)
+        return snapshot.score(queryHists, queryEmbeddings,
+                              self.candidateCount)
+    
+    def _chooseLabel(self, labels, labelSimilarities):
         bestLabel = 'Unknown'
         bestSimilarity = self.minimumSimilarityForPositiveLabel
+        for label, similarity in zip(labels, labelSimilarities):
+            if similarity > bestSimilarity:
+                bestLabel = label
+                bestSimilarity = similarity
+        return bestLabel
+    
+    def _cacheKey(self, snapshot, queryImage, mask):
+        prefix = '%s|%r|%r' % (snapshot.version, self.candidateCount,
+                               self.minimumSimilarityForPositiveLabel)
+        return ClassificationCache.imageKey(queryImage, mask, prefix)
+    
+    def _classifyCached(self, snapshot, queryImages, masks):
+        # Return the best label and dict of similarities by label for each
+        # image, using the cache if any.
+        results = [None] * len(queryImages)
+        cacheKeys = [None] * len(queryImages)
+        uncached = []
+        for i, queryImage in enumerate(queryImages):
+            mask = None if masks is None else masks[i]
+            # The cache key covers only the pixels that are histogrammed.
+            queryImage, mask = self._limitPixels(queryImage, mask)
+            if self.cache is not None:
+                cacheKeys[i] = self._cacheKey(snapshot, queryImage, mask)
+                results[i] = self.cache.get(cacheKeys[i])
+                if results[i] is not None:
+                    continue
+            uncached.append((i, queryImage, mask))
+        batchSize = max(1, min(self.maxBatchElements // max(1, snapshot.nnz),
+                               self.maxBatchElements // self._numBins))
+        for start in xrange(0, len(uncached), batchSize):
+            batch = uncached[start:start + batchSize]
+            queryHists = numpy.empty((len(batch), self._numBins),
+                                     numpy.float32)
+            for j, (_, queryImage, mask) in enumerate(batch):
+                queryHists[j] = self._createNormalizedHist(
+                        queryImage, False, mask, False).ravel()
+            batchSimilarities = self._scoreHists(snapshot, queryHists)
+            for (i, _, _), labelSimilarities in zip(batch,
+                                                    batchSimilarities):
+                label = self._chooseLabel(snapshot.labels, labelSimilarities)
+                similaritiesByLabel = dict(zip(snapshot.labels,
+                                               labelSimilarities))
+                results[i] = (label, similaritiesByLabel)
+                if cacheKeys[i] is not None:
+                    self.cache.put(cacheKeys[i], label, similaritiesByLabel)
+        return results
+    
+    def classify(self, queryImage, queryImageName=None, mask=None):
+        snapshot = self._getSnapshot()
+        masks = None if mask is None else [mask]
+        label, similaritiesByLabel = self._classifyCached(
+                snapshot, [queryImage], masks)[0]
         if self.verbose:
             print '================================================'
             if queryImageName is not None:
                 print 'Query image:'
                 print '    %s' % queryImageName
             print 'Mean similarity to reference images by label:'
-        for label, referenceHists in self._references.iteritems():
-            similarity = 0.0
-            for referenceHist in referenceHists:
-                similarity += numpy.sum(numpy.minimum(
-                        referenceHist.todense(), queryHist))
-            similarity /= len(referenceHists)
-            if self.verbose:
-                print '    %8f  %s' % (similarity, label)
-            if similarity > bestSimilarity:
-                bestLabel = label
-                bestSimilarity = similarity
-        if self.verbose:
+            for printedLabel in snapshot.labels:
+                print '    %8f  %s' % (similaritiesByLabel[printedLabel],
+                                       printedLabel)
             print '================================================'
-        return bestLabel
+        return label
+    
+    def classifyBatch(self, queryImages, masks=None):
+        # Return the best label for each image and a dict of each image's
+        # mean similarity by label. Optionally, masks[i] restricts which
+        # pixels of image i are histogrammed.
+        results = self._classifyCached(self._getSnapshot(), queryImages,
+                                       masks)
+        bestLabels = [label for label, _ in results]
+        similaritiesByLabel = [similarities for _, similarities in results]
+        return bestLabels, similaritiesByLabel
     
     def classifyFromFile(self, path, queryImageName=None):
         if queryImageName is None:
@@ -71,13 +683,277 @@ class HistogramClassifier(object):
         return self.classify(queryImage, queryImageName)
     
     def serialize(self, path, compressed=False):
+        # Paths ending in .mat get the legacy MATLAB format. Other paths
+        # get a model directory.
+        if path.lower().endswith('.mat'):
+            self._serializeMat(path, compressed)
+        else:
+            self._serializeModelDirectory(path)
+    
+    def deserialize(self, path):
+        if os.path.isdir(path):
+            self._deserializeModelDirectory(path)
+        else:
+            self._deserializeMat(path)
+    
+    def _modelHeader(self, sequence):
+        return {
+            'modelId': self._modelId,
+            'numBins': self._numBins,
+            'binsPerChannel': self._binsPerChannel,
+            'colorSpace': self._colorSpace,
+            'maxPixels': self._maxPixels,
+            'minimumSimilarityForPositiveLabel':
+                    self.minimumSimilarityForPositiveLabel,
+            'sequence': sequence,
+            'baseId': uuid.uuid4().hex
+        }
+    
+    def _serializeModelDirectory(self, path):
+        # Save all segments and unsaved changes as one base segment.
+        with self._lock:
+            merged = self._getSnapshot().merge(self._numBins,
+                                               self._embeddingSize)
+            modelId = uuid.uuid4().hex
+            self._modelId = modelId
+            with _ModelDirectoryLock(path):
+                merged.save(path, self._modelHeader(0))
+            segment, header = _ReferenceSegment.load(path)
+            self._setSegments(path, [segment], 0, modelId, header['baseId'])
+    
+    def _deserializeModelDirectory(self, path):
+        segment, header = _ReferenceSegment.load(path)
+        self._setHistConfig(header['binsPerChannel'],
+                            str(header['colorSpace']),
+                            header.get('maxPixels'))
+        self.minimumSimilarityForPositiveLabel = \
+                header['minimumSimilarityForPositiveLabel']
+        modelId = header.get('modelId')
+        if modelId is None:
+            # Identify models saved without an identifier by their header
+            # and the time their data was written.
+            dataPath = os.path.join(path, MODEL_ARRAY_NAMES[0] + '.npy')
+            modelId = hashlib.sha1(
+                    json.dumps(header, sort_keys=True) +
+                    repr(os.path.getmtime(dataPath))).hexdigest()
+        with self._lock:
+            self._setSegments(path, [segment], header.get('sequence', 0),
+                              modelId, header.get('baseId'))
+            self._loadNewDeltas()
+    
+    def _setSegments(self, path, segments, sequence, modelId, baseId=None):
+        # Replace the model with saved segments and no unsaved changes.
+        self._modelId = modelId
+        self._pendingId = None
+        self._references = {}
+        self._referenceEmbeddings = {}
+        self._removedLabels = set()
+        self._segments = segments
+        self._modelPath = path
+        self._modelSequence = sequence
+        self._baseId = baseId
+        self._snapshot = None
+    
+    def _loadNewDeltas(self):
+        # Load any deltas saved since the model was last loaded or saved.
+        # If another instance has replaced the base, its compaction may
+        # have merged deltas that were never loaded here, so reload the
+        # base first, keeping any unsaved changes.
+        try:
+            with open(os.path.join(self._modelPath,
+                                   MODEL_HEADER_FILENAME), 'r') as f:
+                header = json.load(f)
+        except (IOError, ValueError):
+            # The directory is being replaced. Check again later.
+            return
+        if header.get('modelId', self._modelId) != self._modelId:
+            raise ValueError('The model directory now holds a different '
+                             'model; deserialize it again')
+        if header.get('baseId') != self._baseId:
+            segment, header = _ReferenceSegment.load(self._modelPath,
+                                                     self._numBins)
+            self._segments = [segment]
+            self._modelSequence = header.get('sequence', 0)
+            self._baseId = header.get('baseId')
+            self._snapshot = None
+        for sequence, deltaPath in _listDeltas(self._modelPath):
+            if sequence <= self._modelSequence:
+                continue
+            segment, _ = _ReferenceSegment.load(deltaPath, self._numBins)
+            self._segments.append(segment)
+            self._modelSequence = sequence
+            self._snapshot = None
+    
+    def refresh(self):
+        # Load deltas that other processes have saved to the model
+        # directory.
+        with self._lock:
+            if self._modelPath is not None:
+                self._loadNewDeltas()
+    
+    def saveDelta(self):
+        # Append the unsaved references and label removals to the model
+        # directory as a delta segment. Return the delta's path, or None if
+        # there was nothing to save.
+        with self._lock:
+            if self._modelPath is None:
+                raise ValueError('The model has no model directory; '
+                                 'serialize it to one first')
+            if not self._references and not self._removedLabels:
+                self._loadNewDeltas()
+                return None
+            segment = self._compilePendingReferences()
+            # Write the delta beside the model directory, which compaction
+            # may replace meanwhile, and then claim the next sequence
+            # number by moving it into place. A delta directory is never
+            # replaced, so concurrent writers cannot overwrite each other.
+            tempPath = '%s.%s.delta' % (self._modelPath, uuid.uuid4().hex)
+            try:
+                segment.write(tempPath, {'numBins': self._numBins})
+                with _ModelDirectoryLock(self._modelPath):
+                    self._loadNewDeltas()
+                    sequence = self._modelSequence + 1
+                    segment.writeHeader(tempPath, {'numBins': self._numBins,
+                                                   'sequence': sequence})
+                    deltasPath = os.path.join(self._modelPath,
+                                              MODEL_DELTAS_DIRNAME)
+                    if not os.path.exists(deltasPath):
+                        os.makedirs(deltasPath)
+                    deltaPath = os.path.join(deltasPath, '%08d' % sequence)
+                    if os.path.exists(deltaPath):
+                        raise OSError('Delta %s already exists' % deltaPath)
+                    os.rename(tempPath, deltaPath)
+            finally:
+                if os.path.exists(tempPath):
+                    shutil.rmtree(tempPath)
+            self._references = {}
+            self._referenceEmbeddings = {}
+            self._removedLabels = set()
+            self._pendingId = None
+            self._segments.append(segment)
+            self._modelSequence = sequence
+            self._snapshot = None
+            return deltaPath
+    
+    def compact(self, background=False):
+        # Merge the model directory's base and delta segments into a new
+        # base. Classification uses the old segments until the new base is
+        # in place. If background is True, return the compacting thread.
+        if background:
+            thread = threading.Thread(target=self._compact)
+            thread.daemon = True
+            thread.start()
+            return thread
+        self._compact()
+    
+    def _compact(self):
+        with self._lock:
+            if self._modelPath is None:
+                raise ValueError('The model has no model directory; '
+                                 'serialize it to one first')
+            path = self._modelPath
+            segments = list(self._segments)
+            sequence = self._modelSequence
+            baseId = self._baseId
+            header = self._modelHeader(sequence)
+        merged = _ModelSnapshot(segments).merge(self._numBins,
+                                                self._embeddingSize)
+        compactedPath = '%s.%s.compacted' % (path, uuid.uuid4().hex)
+        try:
+            merged.write(compactedPath, header)
+            with self._lock:
+                # Hold the directory lock from listing the deltas until the
+                # new base is in place, so that no delta is saved to the old
+                # directory in between.
+                with _ModelDirectoryLock(path):
+                    if _readBaseId(path) != baseId:
+                        # Another instance replaced the base first, perhaps
+                        # merging deltas that this compaction would drop.
+                        return
+                    # Keep the deltas saved since the compaction began.
+                    for deltaSequence, deltaPath in _listDeltas(path):
+                        if deltaSequence <= sequence:
+                            continue
+                        deltasPath = os.path.join(compactedPath,
+                                                  MODEL_DELTAS_DIRNAME)
+                        if not os.path.exists(deltasPath):
+                            os.makedirs(deltasPath)
+                        os.rename(deltaPath, os.path.join(
+                                deltasPath, os.path.basename(deltaPath)))
+                    _replaceDirectory(compactedPath, path)
+                self._compacted(path, segments)
+        finally:
+            if os.path.exists(compactedPath):
+                shutil.rmtree(compactedPath)
+    
+    def _compacted(self, path, segments):
+        # Replace the compacted segments with the new base.
+        with self._lock:
+            if self._modelPath != path or \
+                    self._segments[:len(segments)] != segments:
+                # The model was replaced during the compaction.
+                return
+            segment, header = _ReferenceSegment.load(path, self._numBins)
+            self._segments = [segment] + self._segments[len(segments):]
+            self._baseId = header['baseId']
+            self._snapshot = None
+    
+    def _collectReferences(self):
+        # Return each label's visible references and embeddings as lists.
+        merged = self._getSnapshot().merge(self._numBins, self._embeddingSize)
+        references = {}
+        referenceEmbeddings = {}
+        for i, label in enumerate(merged.labels):
+            start = merged.labelOffsets[i]
+            stop = merged.labelOffsets[i + 1]
+            references[label] = [
+                    scipy.sparse.csc_matrix(merged.referenceMatrix[row].T)
+                    for row in xrange(start, stop)]
+            referenceEmbeddings[label] = list(
+                    merged.embeddingMatrix[start:stop])
+        return references, referenceEmbeddings
+    
+    def _serializeMat(self, path, compressed):
+        references, referenceEmbeddings = self._collectReferences()
         file = open(path, 'wb')
+        # Save the histogram configuration along with the references.
+        contents = dict(references)
+        contents[BINS_PER_CHANNEL_KEY] = self._binsPerChannel
+        contents[COLOR_SPACE_KEY] = self._colorSpace
+        if self._maxPixels is not None:
+            contents[MAX_PIXELS_KEY] = self._maxPixels
+        # Save the nearest neighbor index's embeddings, labelled by row.
+        embeddings = []
+        embeddingLabels = []
+        for label, labelEmbeddings in referenceEmbeddings.iteritems():
+            embeddings += list(labelEmbeddings)
+            embeddingLabels += [label] * len(labelEmbeddings)
+        if embeddings:
+            contents[EMBEDDINGS_KEY] = numpy.vstack(embeddings)
+            contents[EMBEDDING_LABELS_KEY] = numpy.array(
+                    embeddingLabels, dtype=object)
         scipy.io.savemat(
-            file, self._references, do_compression=compressed)
+            file, contents, do_compression=compressed)
     
-    def deserialize(self, path):
+    def _deserializeMat(self, path):
+        # Identify the model by its file's contents.
+        with open(path, 'rb') as file:
+            modelId = hashlib.sha1(file.read()).hexdigest()
+        self._setSegments(None, [], 0, modelId)
         file = open(path, 'rb')
         self._references = scipy.io.loadmat(file)
+        # Restore the histogram configuration.
+        # Models saved without one use 256 BGR bins per channel and
+        # full-size images.
+        binsPerChannel = self._references.pop(BINS_PER_CHANNEL_KEY, 256)
+        colorSpace = self._references.pop(COLOR_SPACE_KEY, ['BGR'])
+        maxPixels = self._references.pop(MAX_PIXELS_KEY, None)
+        if maxPixels is not None:
+            maxPixels = int(numpy.squeeze(maxPixels))
+        self._setHistConfig(int(numpy.squeeze(binsPerChannel)),
+                            str(colorSpace[0]), maxPixels)
+        embeddings = self._references.pop(EMBEDDINGS_KEY, None)
+        embeddingLabels = self._references.pop(EMBEDDING_LABELS_KEY, None)
         for key in self._references.keys():
             value = self._references[key]
             if not isinstance(value, numpy.ndarray):
@@ -87,98 +963,195 @@ class HistogramClassifier(object):
             # The serializer wraps the data in an extra array.
             # Unwrap the data.
             self._references[key] = value[0]
+        # Restore the nearest neighbor index's embeddings.
+        self._referenceEmbeddings = {}
+        if embeddings is not None:
+            for embedding, label in zip(embeddings, embeddingLabels.ravel()):
+                label = label[0]
+                if label not in self._referenceEmbeddings:
+                    self._referenceEmbeddings[label] = [embedding]
+                else:
+                    self._referenceEmbeddings[label] += [embedding]
+        else:
+            # Models saved without embeddings get them computed now.
+            for label, referenceHists in self._references.iteritems():
+                self._referenceEmbeddings[label] = [
+                        self._embedHist(hist.tocsc().indices, hist.tocsc().data)
+                        for hist in referenceHists]
+
+# Each training process histograms images with its own classifier.
+_trainingClassifier = None
+
+def _initTrainingWorker(binsPerChannel, colorSpace, maxPixels):
+    global _trainingClassifier
+    _trainingClassifier = HistogramClassifier(binsPerChannel, colorSpace,
+                                              maxPixels)
+
+def _createReferenceHistFromFile(pathAndLabel):
+    # Return the path, label, and sparse histogram's nonzero indices and
+    # values, or None for both if the image cannot be read.
+    path, label = pathAndLabel
+    image = cv2.imread(path, cv2.CV_LOAD_IMAGE_COLOR)
+    if image is None:
+        return path, label, None, None
+    hist = _trainingClassifier._createNormalizedHist(image, True)
+    return path, label, hist.indices, hist.data
+
+def readManifest(path):
+    # Return (path, label) pairs from a CSV file of path,label rows or a
+    # JSON file of [path, label] pairs. Relative image paths are relative
+    # to the manifest.
+    baseDir = os.path.dirname(os.path.abspath(path))
+    with open(path, 'rb') as f:
+        if path.lower().endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = [row for row in csv.reader(f) if row]
+    return [(os.path.join(baseDir, imagePath), label)
+            for imagePath, label in rows]
+
+def listLabelDirectories(rootPath):
+    # Return (path, label) pairs for the files in each subdirectory of the
+    # root, labelled by the subdirectory's name.
+    pathsAndLabels = []
+    for label in sorted(os.listdir(rootPath)):
+        labelPath = os.path.join(rootPath, label)
+        if not os.path.isdir(labelPath):
+            continue
+        for filename in sorted(os.listdir(labelPath)):
+            pathsAndLabels.append((os.path.join(labelPath, filename), label))
+    return pathsAndLabels
 
 def main():
-    classifier = HistogramClassifier()
+    parser = argparse.ArgumentParser(
+            description='Train a histogram classifier.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--manifest',
+                        help='CSV or JSON file of image paths and labels')
+    source.add_argument('--directory',
+                        help='directory with a subdirectory per label')
+    parser.add_argument('--output', default='classifier.model',
+                        help='model path; a .mat path uses the old format')
+    parser.add_argument('--bins', type=int, default=256,
+                        help='histogram bins per channel')
+    parser.add_argument('--color-space', default='BGR',
+                        choices=sorted(COLOR_CONVERSIONS.keys()))
+    parser.add_argument('--max-pixels', type=int, default=None,
+                        help='subsample larger images to this many pixels')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of training processes')
+    parser.add_argument('--append', action='store_true',
+                        help='save changes to the existing model directory '
+                             'as a delta instead of retraining')
+    parser.add_argument('--remove-label', action='append', default=[],
+                        help='remove a label before adding any references')
+    parser.add_argument('--compact', action='store_true',
+                        help='merge the model directory\'s deltas')
+    args = parser.parse_args()
+    
+    if args.append or args.compact:
+        classifier = HistogramClassifier()
+        classifier.deserialize(args.output)
+    else:
+        classifier = HistogramClassifier(args.bins, args.color_space,
+                                         args.max_pixels)
     classifier.verbose = True
     
-    # 'Stalinist, interior' reference images
-    classifier.addReferenceFromFile(
-            'images/communal_apartments_01.jpg',
-            'Stalinist, interior')
-    classifier.addReferenceFromFile(
-            'images/communal_apartments_04.jpg',
-            'Stalinist, interior')
-    classifier.addReferenceFromFile(
-            'images/communal_apartments_13.jpg',
-            'Stalinist, interior')
-    classifier.addReferenceFromFile(
-            'images/communal_apartments_19.jpg',
-            'Stalinist, interior')
-    classifier.addReferenceFromFile(
-            'images/magangue_room.jpg',
-            'Stalinist, interior')
-    classifier.addReferenceFromFile(
-            'images/moscow_concrete_hall.jpg',
-            'Stalinist, interior')
-    classifier.addReferenceFromFile(
-            'images/moscow_flat_30.jpg',
-            'Stalinist, interior')
-    classifier.addReferenceFromFile(
-            'images/moscow_flat_31.jpg',
-            'Stalinist, interior')
-    classifier.addReferenceFromFile(
-            'images/moscow_flat_36.jpg',
-            'Stalinist, interior')
-    classifier.addReferenceFromFile(
-            'images/moscow_flat_43.jpg',
-            'Stalinist, interior')
-    
-    # 'Stalinist, exterior' reference images
-    classifier.addReferenceFromFile(
-            'images/murmansk_exterior.jpg',
-            'Stalinist, exterior')
-    classifier.addReferenceFromFile(
-            'images/norilsk_exterior.jpg',
-            'Stalinist, exterior')
-    classifier.addReferenceFromFile(
-            'images/st_petersburg_exterior.jpg',
-            'Stalinist, exterior')
-    
-    # 'Luxury, interior' reference images
-    classifier.addReferenceFromFile(
-            'images/dubai_damac_heights.jpg',
-            'Luxury, interior')
-    classifier.addReferenceFromFile(
-            'images/kazan_jacuzzi.jpg',
-            'Luxury, interior')
-    classifier.addReferenceFromFile(
-            'images/london_holland_park.jpg',
-            'Luxury, interior')
-    classifier.addReferenceFromFile(
-            'images/miami_beach.jpg',
-            'Luxury, interior')
-    classifier.addReferenceFromFile(
-            'images/miami_moroccan_inspired.jpg',
-            'Luxury, interior')
-    classifier.addReferenceFromFile(
-            'images/panama_casa_del_horno.jpg',
-            'Luxury, interior')
-    classifier.addReferenceFromFile(
-            'images/panama_pacific_point.jpg',
-            'Luxury, interior')
-    classifier.addReferenceFromFile(
-            'images/sydney_potts_point.jpg',
-            'Luxury, interior')
-    
-    # 'Luxury, exterior' reference images
-    classifier.addReferenceFromFile(
-            'images/buenos_aires_recoleta_exterior.jpg',
-            'Luxury, exterior')
-    classifier.addReferenceFromFile(
-            'images/herradura_exterior.jpg',
-            'Luxury, exterior')
-    classifier.addReferenceFromFile(
-            'images/nuevo_vallarta_grand_maya.jpg',
-            'Luxury, exterior')
-    classifier.addReferenceFromFile(
-            'images/panama_trump_exterior.jpg',
-            'Luxury, exterior')
-    
-    classifier.serialize('classifier.mat')
-    classifier.deserialize('classifier.mat')
-    classifier.classifyFromFile('images/dubai_damac_heights.jpg')
-    classifier.classifyFromFile('images/communal_apartments_01.jpg')
+    if args.manifest is not None:
+        pathsAndLabels = readManifest(args.manifest)
+    elif args.directory is not None:
+        pathsAndLabels = listLabelDirectories(args.directory)
+    elif args.append or args.compact:
+        pathsAndLabels = []
+    else:
+        pathsAndLabels = _bundledReferences()
+    
+    for label in args.remove_label:
+        classifier.removeLabel(label)
+    
+    if pathsAndLabels:
+        startTime = time.time()
+        numAdded, skippedPaths = classifier.addReferencesFromFiles(
+                pathsAndLabels, args.processes)
+        elapsed = time.time() - startTime
+        print 'Trained on %d images in %.1f s (%.1f images/s), ' \
+              'skipped %d' % (numAdded, elapsed,
+                              numAdded / max(elapsed, 1e-6),
+                              len(skippedPaths))
+    
+    if args.append or args.compact:
+        classifier.saveDelta()
+        if args.compact:
+            classifier.compact()
+        return
+    
+    classifier.serialize(args.output)
+    classifier.deserialize(args.output)
+    if args.manifest is None and args.directory is None:
+        classifier.classifyFromFile('images/dubai_damac_heights.jpg')
+        classifier.classifyFromFile('images/communal_apartments_01.jpg')
+
+def _bundledReferences():
+    # Return (path, label) pairs for the app's bundled reference images.
+    return [
+        # 'Stalinist, interior' reference images
+        ('images/communal_apartments_01.jpg',
+         'Stalinist, interior'),
+        ('images/communal_apartments_04.jpg',
+         'Stalinist, interior'),
+        ('images/communal_apartments_13.jpg',
+         'Stalinist, interior'),
+        ('images/communal_apartments_19.jpg',
+         'Stalinist, interior'),
+        ('images/magangue_room.jpg',
+         'Stalinist, interior'),
+        ('images/moscow_concrete_hall.jpg',
+         'Stalinist, interior'),
+        ('images/moscow_flat_30.jpg',
+         'Stalinist, interior'),
+        ('images/moscow_flat_31.jpg',
+         'Stalinist, interior'),
+        ('images/moscow_flat_36.jpg',
+         'Stalinist, interior'),
+        ('images/moscow_flat_43.jpg',
+         'Stalinist, interior'),
+        
+        # 'Stalinist, exterior' reference images
+        ('images/murmansk_exterior.jpg',
+         'Stalinist, exterior'),
+        ('images/norilsk_exterior.jpg',
+         'Stalinist, exterior'),
+        ('images/st_petersburg_exterior.jpg',
+         'Stalinist, exterior'),
+        
+        # 'Luxury, interior' reference images
+        ('images/dubai_damac_heights.jpg',
+         'Luxury, interior'),
+        ('images/kazan_jacuzzi.jpg',
+         'Luxury, interior'),
+        ('images/london_holland_park.jpg',
+         'Luxury, interior'),
+        ('images/miami_beach.jpg',
+         'Luxury, interior'),
+        ('images/miami_moroccan_inspired.jpg',
+         'Luxury, interior'),
+        ('images/panama_casa_del_horno.jpg',
+         'Luxury, interior'),
+        ('images/panama_pacific_point.jpg',
+         'Luxury, interior'),
+        ('images/sydney_potts_point.jpg',
+         'Luxury, interior'),
+        
+        # 'Luxury, exterior' reference images
+        ('images/buenos_aires_recoleta_exterior.jpg',
+         'Luxury, exterior'),
+        ('images/herradura_exterior.jpg',
+         'Luxury, exterior'),
+        ('images/nuevo_vallarta_grand_maya.jpg',
+         'Luxury, exterior'),
+        ('images/panama_trump_exterior.jpg',
+         'Luxury, exterior')
+    ]
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
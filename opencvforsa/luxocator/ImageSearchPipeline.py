@@ -0,0 +1,209 @@
+from py_ms_cognitive import PyMsCognitiveImageSearch
+from py_ms_cognitive.py_ms_cognitive_search.py_ms_cognitive_image_search \
+    import ImageResult
+from py_ms_cognitive.py_ms_cognitive_search.py_ms_cognitive_search \
+    import PyMsCognitiveSearch
+from multiprocessing.pool import ThreadPool
+import numpy # Hint to PyInstaller
+from CVForwardCompat import cv2
+import Queue
+import requests
+import sys
+import time
+
+import RequestsUtils
+
+
+class ImageSearchPipeline(object):
+    
+    # Fetches pages of image search results concurrently and downloads and
+    # decodes the images behind the page fetches, with at most
+    # maxConcurrency requests in flight. Results are yielded as they
+    # complete, so their order differs from the search's order.
+    
+    def __init__(self, apiKey,
+                 baseUrl=PyMsCognitiveImageSearch.SEARCH_IMAGE_BASE,
+                 customParams='', maxConcurrency=8, pageSize=50,
+                 reduction=1, session=None, timeout=30):
+        self.verbose = False
+        
+        self._apiKey = apiKey
+        self._queryUrl = baseUrl + customParams
+        self._maxConcurrency = maxConcurrency
+        self._pageSize = pageSize
+        self._reduction = reduction
+        if session is None:
+            session = RequestsUtils.createSession(maxConcurrency)
+        self._session = session
+        self._timeout = timeout
+        
+        self._numResultsAvailable = 0
+        self._numPagesFetched = 0
+        self._numImagesFetched = 0
+    
+    @property
+    def maxConcurrency(self):
+        return self._maxConcurrency
+    
+    @property
+    def numResultsAvailable(self):
+        return self._numResultsAvailable
+    
+    @property
+    def numPagesFetched(self):
+        return self._numPagesFetched
+    
+    @property
+    def numImagesFetched(self):
+        return self._numImagesFetched
+    
+    def results(self, query, limit=50, offset=0):
+        # Yield up to limit (ImageResult, image) pairs, starting from the
+        # search result at offset. The image is None if it could not be
+        # downloaded or decoded.
+        self._numResultsAvailable = 0
+        self._numPagesFetched = 0
+        self._numImagesFetched = 0
+        
+        pool = ThreadPool(self._maxConcurrency)
+        # Bound the decoded images waiting for the consumer, so that a slow
+        # consumer holds back the downloads.
+        completed = Queue.Queue(self._maxConcurrency)
+        # The workers check this before starting a request, so that
+        # abandoning the iterator stops further requests.
+        cancelled = []
+        
+        def post(item):
+            # Wait for room in the queue unless the iterator is abandoned.
+            while not cancelled:
+                try:
+                    completed.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+        
+        # The workers always report completion, even on unexpected errors,
+        # since the iterator waits for every task it has scheduled.
+        def fetchPage(pageOffset, count):
+            if cancelled:
+                return
+            page = [], None
+            try:
+                page = self._fetchPage(query, pageOffset, count)
+            except Exception as e:
+                print >> sys.stderr, \
+                    'Error when requesting image search for "%s" at ' \
+                    'offset %d: %s' % (query, pageOffset, e)
+            finally:
+                post(('page', pageOffset, page))
+        
+        def fetchImage(result):
+            if cancelled:
+                return
+            image = None
+            try:
+                image = self._fetchImage(result)
+            except Exception as e:
+                print >> sys.stderr, \
+                    'Failed to fetch image from %s: %s' % \
+                    (result.content_url, e)
+            finally:
+                post(('image', result, image))
+        
+        # Fetch the first page alone to learn how many results there are.
+        numPending = 1
+        pool.apply_async(fetchPage,
+                         (offset, min(self._pageSize, limit)))
+        numResultsScheduled = 0
+        firstPage = True
+        try:
+            while numPending > 0:
+                kind, key, value = completed.get()
+                numPending -= 1
+                if kind == 'image':
+                    self._numImagesFetched += 1
+                    yield key, value
+                    continue
+                results, numResultsAvailable = value
+                self._numPagesFetched += 1
+                if firstPage and results:
+                    firstPage = False
+                    self._numResultsAvailable = numResultsAvailable
+                    # Fetch the remaining pages concurrently.
+                    stop = offset + limit
+                    if numResultsAvailable is not None:
+                        stop = min(stop, numResultsAvailable)
+                    for pageOffset in xrange(offset + self._pageSize, stop,
+                                             self._pageSize):
+                        numPending += 1
+                        pool.apply_async(
+                                fetchPage,
+                                (pageOffset,
+                                 min(self._pageSize, stop - pageOffset)))
+                # Download this page's images while other pages load.
+                for result in results[:limit - numResultsScheduled]:
+                    numResultsScheduled += 1
+                    numPending += 1
+                    pool.apply_async(fetchImage, (result,))
+        finally:
+            cancelled.append(True)
+            pool.terminate()
+    
+    def _fetchPage(self, query, offset, count):
+        # Return a page's list of ImageResult objects and the estimated
+        # number of results available, or an empty list and None on error.
+        payload = {
+            'q': query,
+            'count': count,
+            'offset': offset
+        }
+        headers = {'Ocp-Apim-Subscription-Key': self._apiKey}
+        # Share the search API's quota with other searches.
+        PyMsCognitiveSearch.rate_limiter.acquire()
+        startTime = time.time()
+        try:
+            response = self._session.get(self._queryUrl, params=payload,
+                                         headers=headers,
+                                         timeout=self._timeout)
+            response.raise_for_status()
+            json = response.json()
+        except (requests.RequestException, ValueError) as e:
+            print >> sys.stderr, \
+                'Error when requesting image search for "%s" at offset ' \
+                '%d: %s' % (query, offset, e)
+            return [], None
+        if self.verbose:
+            print 'Received results %d to %d of image search for "%s" ' \
+                  'in %.3f seconds' % \
+                  (offset, offset + count - 1, query,
+                   time.time() - startTime)
+        results = [ImageResult(resultJson)
+                   for resultJson in json.get('value', [])]
+        return results, json.get('totalEstimatedMatches')
+    
+    def _fetchImage(self, result):
+        return RequestsUtils.cvImageFromUrl(result.content_url,
+                                            self._reduction, self._session,
+                                            self._timeout)
+
+
+def main():
+    # TODO: Replace the x's with the Primary Account Key of your
+    # Microsoft Account.
+    bingKey = ''
+    
+    pipeline = ImageSearchPipeline(
+            bingKey, customParams='?color=ColorOnly&imageType=Photo')
+    pipeline.verbose = True
+    startTime = time.time()
+    for result, image in pipeline.results('luxury condo sales', 100):
+        if image is None:
+            print 'Failed: %s' % result.content_url
+        else:
+            print '%dx%d: %s' % (image.shape[1], image.shape[0],
+                                 result.content_url)
+    print 'Received %d images in %.3f seconds' % \
+          (pipeline.numImagesFetched, time.time() - startTime)
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,54 @@
 from py_ms_cognitive import PyMsCognitiveImageSearch
+from py_ms_cognitive.py_ms_cognitive_search.py_ms_cognitive_image_search \
+    import ImageResult
+import collections
+from multiprocessing.pool import ThreadPool
 import numpy # Hint to PyInstaller
 from CVForwardCompat import cv2
 import pprint
 import sys
+import threading
 
 import RequestsUtils
 
 
 class ImageSearchSession(object):
     
-    def __init__(self):
+    def __init__(self, numPrefetch=0, numPrefetchThreads=4,
+                 prefetchByteBudget=128*1024*1024, classifier=None,
+                 searchCache=None):
         self.verbose = False
         
+        # An optional SearchCache of responses, so that repeated searches
+        # and paging back do not request the same page again.
+        self.searchCache = searchCache
+        
         self._query = ''
         self._results = []
         self._offset = 0
         self._numResultsRequested = 0
         self._numResultsReceived = 0
         self._numResultsAvailable = 0
+        
+        # If numPrefetch > 0, that many results ahead of the last one
+        # requested are downloaded, decoded, and, if there is a classifier,
+        # classified on a pool of threads. They are kept in a least
+        # recently used cache, keyed by absolute result index, of up to
+        # prefetchByteBudget bytes of images.
+        self._numPrefetch = numPrefetch
+        self._prefetchByteBudget = prefetchByteBudget
+        self._classifier = classifier
+        if numPrefetch > 0:
+            self._prefetchPool = ThreadPool(numPrefetchThreads)
+        else:
+            self._prefetchPool = None
+        self._prefetchLock = threading.Lock()
+        self._prefetched = collections.OrderedDict()
+        self._prefetchedBytes = 0
+        self._prefetching = set()
+        # Each search starts a new generation. Prefetches from older
+        # generations are abandoned.
+        self._generation = 0
     
     @property
     def query(self):
@@ -39,6 +70,14 @@ class ImageSearchSession(object):
     def numResultsAvailable(self):
         return self._numResultsAvailable
     
+    @property
+    def numPrefetch(self):
+        return self._numPrefetch
+    
+    @property
+    def prefetchedBytes(self):
+        return self._prefetchedBytes
+    
     def searchPrev(self):
         if self._offset == 0:
             return
@@ -56,27 +95,50 @@ class ImageSearchSession(object):
         # TODO: Replace the x's with the Primary Account Key of your
         # Microsoft Account.
         bingKey = ''
+        customParams = '?color=ColorOnly&imageType=Photo'
+        
+        with self._prefetchLock:
+            self._generation += 1
+            self._prefetching.clear()
+            if query != self._query:
+                # Cached results belong to the old query.
+                self._prefetched.clear()
+                self._prefetchedBytes = 0
         
         self._query = query
         self._numResultsRequested = numResultsRequested
         self._offset = offset
         
-        searchService = PyMsCognitiveImageSearch(
-                bingKey, query,
-                custom_params='?color=ColorOnly&imageType=Photo')
-        searchService.current_offset = offset
+        json = None
+        if self.searchCache is not None:
+            json = self.searchCache.get(query, customParams, offset,
+                                        numResultsRequested)
         
-        try:
-            self._results = searchService.search(numResultsRequested, 'json')
-        except Exception as e:
-            print >> sys.stderr, \
-                'Error when requesting Bing image search for "%s":' % query
-            print >> sys.stderr, e.message
-            self._offset = 0
-            self._numResultsReceived = 0
-            return
+        if json is not None:
+            self._results = [ImageResult(resultJson)
+                             for resultJson in json[u'value']]
+        else:
+            searchService = PyMsCognitiveImageSearch(
+                    bingKey, query, custom_params=customParams)
+            searchService.current_offset = offset
+            
+            try:
+                self._results = searchService.search(numResultsRequested,
+                                                     'json')
+            except Exception as e:
+                print >> sys.stderr, \
+                    'Error when requesting Bing image search for "%s":' % \
+                    query
+                print >> sys.stderr, e.message
+                self._offset = 0
+                self._numResultsReceived = 0
+                return
+            
+            json = searchService.most_recent_json
+            if self.searchCache is not None:
+                self.searchCache.put(query, customParams, offset,
+                                     numResultsRequested, json)
         
-        json = searchService.most_recent_json
         self._numResultsReceived = len(self._results)
         if self._numResultsRequested < self._numResultsReceived:
             # py_ms_cognitive modified the request to get more results.
@@ -87,16 +149,113 @@ class ImageSearchSession(object):
             print 'Received results of Bing image search for "%s":' % query
             pprint.pprint(json)
         
+        self._prefetchFrom(0)
+    
+    def getUrl(self, index, useThumbnail = False):
+        if index >= self._numResultsReceived:
+            return None
+        result = self._results[index]
+        if useThumbnail:
+            return result.thumbnail_url
+        return result.content_url
     
     def getCvImageAndUrl(self, index, useThumbnail = False):
         if index >= self._numResultsReceived:
             return None, None
-        result = self._results[index]
         if useThumbnail:
-            url = result.thumbnail_url
-        else:
-            url = result.content_url
-        return RequestsUtils.cvImageFromUrl(url), url
+            url = self.getUrl(index, True)
+            return RequestsUtils.cvImageFromUrl(url), url
+        image, url, _ = self.getCvImageUrlAndLabel(index)
+        return image, url
+    
+    def getCvImageUrlAndLabel(self, index):
+        # Return the result's image, URL, and label from the classifier, if
+        # any, using a prefetched result if available. Without an image,
+        # the label is an error message.
+        if index >= self._numResultsReceived:
+            return None, None, 'Failed to decode image'
+        url = self._results[index].content_url
+        absoluteIndex = self._offset + index
+        with self._prefetchLock:
+            entry = self._prefetched.get(absoluteIndex)
+            if entry is not None and entry[1] == url:
+                # Mark the entry as the most recently used.
+                del self._prefetched[absoluteIndex]
+                self._prefetched[absoluteIndex] = entry
+        if entry is None or entry[1] != url:
+            entry = self._loadResult(url)
+            self._storePrefetched(self._generation, absoluteIndex, entry)
+        self._prefetchFrom(index + 1)
+        return entry
+    
+    def _loadResult(self, url):
+        image = RequestsUtils.cvImageFromUrl(url)
+        label = None
+        if image is None:
+            label = 'Failed to decode image'
+        elif self._classifier is not None:
+            label = self._classifier.classify(image, url)
+        return image, url, label
+    
+    def _prefetchFrom(self, index):
+        # Queue the results from index to index + numPrefetch that are not
+        # cached or already being prefetched.
+        if self._prefetchPool is None:
+            return
+        stop = min(index + self._numPrefetch, self._numResultsReceived)
+        with self._prefetchLock:
+            generation = self._generation
+            for i in xrange(index, stop):
+                absoluteIndex = self._offset + i
+                if absoluteIndex in self._prefetched or \
+                        absoluteIndex in self._prefetching:
+                    continue
+                self._prefetching.add(absoluteIndex)
+                self._prefetchPool.apply_async(
+                        self._prefetch,
+                        (generation, absoluteIndex,
+                         self._results[i].content_url))
+    
+    def _prefetch(self, generation, absoluteIndex, url):
+        if generation != self._generation:
+            # A new search has started, so this result is unwanted.
+            return
+        try:
+            entry = self._loadResult(url)
+        except Exception as e:
+            print >> sys.stderr, 'Failed to prefetch %s: %s' % (url, e)
+            return
+        finally:
+            with self._prefetchLock:
+                if generation == self._generation:
+                    self._prefetching.discard(absoluteIndex)
+        self._storePrefetched(generation, absoluteIndex, entry)
+    
+    def _storePrefetched(self, generation, absoluteIndex, entry):
+        image = entry[0]
+        if self._prefetchPool is None or image is None or \
+                image.nbytes > self._prefetchByteBudget:
+            # Failed downloads are not cached so that they may be retried.
+            return
+        with self._prefetchLock:
+            if generation != self._generation or \
+                    absoluteIndex in self._prefetched:
+                return
+            self._prefetched[absoluteIndex] = entry
+            self._prefetchedBytes += image.nbytes
+            # Evict the least recently used results to fit the budget.
+            while self._prefetchedBytes > self._prefetchByteBudget:
+                _, (evictedImage, _, _) = self._prefetched.popitem(last=False)
+                self._prefetchedBytes -= evictedImage.nbytes
+    
+    def close(self):
+        if self.searchCache is not None:
+            self.searchCache.close()
+        if self._prefetchPool is not None:
+            with self._prefetchLock:
+                self._generation += 1
+            self._prefetchPool.terminate()
+            self._prefetchPool = None
 
 def main():
     session = ImageSearchSession()
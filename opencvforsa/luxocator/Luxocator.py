@@ -4,8 +4,10 @@ import os
 import threading
 import wx
 
+from ClassificationCache import ClassificationCache
 from HistogramClassifier import HistogramClassifier
 from ImageSearchSession import ImageSearchSession
+from SearchCache import SearchCache
 import PyInstallerUtils
 import ResizeUtils
 import WxUtils
@@ -15,7 +17,10 @@ class Luxocator(wx.Frame):
     
     def __init__(self, classifierPath, maxImageSize=768,
                  verboseSearchSession=False,
-                 verboseClassifier=False):
+                 verboseClassifier=False,
+                 classificationCachePath=None,
+                 searchCachePath=None,
+                 numPrefetch=4):
         
         style = wx.CLOSE_BOX | wx.MINIMIZE_BOX | wx.CAPTION | \
             wx.SYSTEM_MENU | wx.CLIP_CHILDREN
@@ -26,14 +31,23 @@ class Luxocator(wx.Frame):
         border = 12
         defaultQuery = 'luxury condo sales'
         
-        self._index = 0
-        self._session = ImageSearchSession()
-        self._session.verbose = verboseSearchSession
-        self._session.search(defaultQuery)
-        
         self._classifier = HistogramClassifier()
         self._classifier.verbose = verboseClassifier
         self._classifier.deserialize(classifierPath)
+        if classificationCachePath is not None:
+            self._classifier.cache = ClassificationCache(
+                    classificationCachePath)
+        
+        self._index = 0
+        # The session prefetches and classifies the next few results.
+        searchCache = None
+        if searchCachePath is not None:
+            searchCache = SearchCache(searchCachePath)
+        self._session = ImageSearchSession(numPrefetch,
+                                           classifier=self._classifier,
+                                           searchCache=searchCache)
+        self._session.verbose = verboseSearchSession
+        self._session.search(defaultQuery)
         
         self.Bind(wx.EVT_CLOSE, self._onCloseWindow)
         
@@ -102,6 +116,15 @@ class Luxocator(wx.Frame):
         self._classifier.verbose = value
     
     def _onCloseWindow(self, event):
+        searchCache = self._session.searchCache
+        if searchCache is not None and self.verboseSearchSession:
+            searchCache.printStats()
+        self._session.close()
+        cache = self._classifier.cache
+        if cache is not None:
+            if self.verboseClassifier:
+                cache.printStats()
+            cache.close()
         self.Destroy()
     
     def _onSearchEntered(self, event):
@@ -150,15 +173,10 @@ class Luxocator(wx.Frame):
                 target=self._updateImageAndControlsAsync).start()
     
     def _updateImageAndControlsAsync(self):
-        # Get the current image.
-        image, url = self._session.getCvImageAndUrl(
+        # Get the current image and its label.
+        image, url, label = self._session.getCvImageUrlAndLabel(
             self._index % self._session.numResultsRequested)
-        if image is None:
-            # Provide an error message.
-            label = 'Failed to decode image'
-        else:
-            # Classify the image.
-            label = self._classifier.classify(image, url)
+        if image is not None:
             # Resize the image while maintaining its aspect ratio.
             image = ResizeUtils.cvResizeAspectFill(
                     image, self._maxImageSize)
@@ -192,8 +210,14 @@ def main():
             PyInstallerUtils.resourcePath('cacert.pem')
     app = wx.App()
     luxocator = Luxocator(
-            PyInstallerUtils.resourcePath('classifier.mat'),
-            verboseSearchSession=False, verboseClassifier=False)
+            PyInstallerUtils.resourcePath('classifier.model'),
+            verboseSearchSession=False, verboseClassifier=False,
+            classificationCachePath=os.path.join(
+                    os.path.expanduser('~'), '.luxocator',
+                    'classifications.sqlite'),
+            searchCachePath=os.path.join(
+                    os.path.expanduser('~'), '.luxocator',
+                    'searches.sqlite'))
     luxocator.Show()
     app.MainLoop()
 
@@ -21,8 +21,8 @@ if platform == 'nt':
 # Include SSL certificates for the sake of the 'requests' module.
 a.datas.append(('cacert.pem', 'cacert.pem', 'DATA'))
 
-# Include our app's classifier data.
-a.datas.append(('classifier.mat', 'classifier.mat', 'DATA'))
+# Include our app's classifier data, which is a directory.
+a.datas += Tree('classifier.model', prefix='classifier.model')
 
 pyz = PYZ(a.pure)
 
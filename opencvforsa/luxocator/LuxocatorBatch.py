@@ -0,0 +1,316 @@
+import argparse
+import json
+import numpy # Hint to PyInstaller
+from CVForwardCompat import cv2
+import os
+import Queue
+import sys
+import threading
+import time
+
+from ClassificationCache import ClassificationCache
+from HistogramClassifier import HistogramClassifier
+from ImageSearchSession import ImageSearchSession
+from SearchCache import SearchCache
+import RequestsUtils
+
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff')
+
+# Marks the end of a stage's input.
+_END = None
+
+
+class LuxocatorBatch(object):
+    
+    # Classifies images from searches, manifests, and directories without a
+    # GUI. Searching, fetching (downloading and decoding), and classifying
+    # run as concurrent stages connected by bounded queues, so that slow
+    # downloads overlap with classification.
+    
+    def __init__(self, classifier, searchCache=None, numFetchThreads=16,
+                 numClassifyThreads=2, batchSize=8, reduction=1,
+                 queueSize=64):
+        self._classifier = classifier
+        self._searchCache = searchCache
+        self._numFetchThreads = numFetchThreads
+        self._numClassifyThreads = numClassifyThreads
+        self._batchSize = batchSize
+        self._reduction = reduction
+        self._queueSize = queueSize
+        
+        self._numImages = 0
+        self._numFailed = 0
+        self._elapsed = 0.0
+    
+    @property
+    def numImages(self):
+        return self._numImages
+    
+    @property
+    def numFailed(self):
+        return self._numFailed
+    
+    @property
+    def elapsed(self):
+        return self._elapsed
+    
+    @property
+    def imagesPerSecond(self):
+        return self._numImages / max(self._elapsed, 1e-6)
+    
+    def run(self, queries, locations, output, numResultsPerQuery=50):
+        # Classify up to numResultsPerQuery search results for each query,
+        # and each image path or URL in locations, writing a line of JSON
+        # per image to the output file.
+        self._numImages = 0
+        self._numFailed = 0
+        startTime = time.time()
+        
+        jobs = Queue.Queue(self._queueSize)
+        images = Queue.Queue(self._queueSize)
+        results = Queue.Queue(self._queueSize)
+        
+        self._startStage(
+                lambda inputQueue, outputQueue: self._search(
+                        queries, locations, numResultsPerQuery, outputQueue),
+                None, jobs, 1, self._numFetchThreads)
+        self._startStage(self._fetch, jobs, images, self._numFetchThreads,
+                         self._numClassifyThreads)
+        self._startStage(self._classify, images, results,
+                         self._numClassifyThreads, 1)
+        
+        while True:
+            record = results.get()
+            if record is _END:
+                break
+            self._numImages += 1
+            if record['label'] is None:
+                self._numFailed += 1
+            output.write(json.dumps(record, sort_keys=True) + '\n')
+        output.flush()
+        
+        self._elapsed = time.time() - startTime
+    
+    def _startStage(self, function, inputQueue, outputQueue, numThreads,
+                    numNextThreads):
+        # Run numThreads threads that each call the function with
+        # inputQueue and outputQueue. When all of them have returned, mark
+        # the end of input once for each thread of the next stage, even if
+        # the function raised, so that the later stages still finish.
+        remaining = [numThreads]
+        lock = threading.Lock()
+        def work():
+            try:
+                function(inputQueue, outputQueue)
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    isLast = remaining[0] == 0
+                if isLast:
+                    for _ in xrange(numNextThreads):
+                        outputQueue.put(_END)
+        for _ in xrange(numThreads):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+    
+    def _search(self, queries, locations, numResultsPerQuery, jobs):
+        for location in locations:
+            jobs.put({'source': location, 'url': location, 'search': 0.0})
+        session = ImageSearchSession(searchCache=self._searchCache)
+        for query in queries:
+            offset = 0
+            while offset < numResultsPerQuery:
+                startTime = time.time()
+                session.search(query, min(50, numResultsPerQuery - offset),
+                               offset)
+                searchTime = time.time() - startTime
+                numResults = min(session.numResultsReceived,
+                                 numResultsPerQuery - offset)
+                for index in xrange(numResults):
+                    jobs.put({'source': query,
+                              'url': session.getUrl(index),
+                              'search': searchTime})
+                offset += session.numResultsReceived
+                if session.numResultsReceived == 0 or \
+                        offset >= session.numResultsAvailable:
+                    break
+    
+    def _fetch(self, jobs, images):
+        while True:
+            job = jobs.get()
+            if job is _END:
+                return
+            url = job['url']
+            startTime = time.time()
+            # A failure loses only this job, which is reported as failed.
+            image = None
+            try:
+                if url.startswith('http://') or \
+                        url.startswith('https://'):
+                    image = RequestsUtils.cvImageFromUrl(url,
+                                                         self._reduction)
+                else:
+                    image = cv2.imread(url, cv2.CV_LOAD_IMAGE_COLOR)
+            except Exception as e:
+                print >> sys.stderr, 'Failed to fetch %s: %s' % (url, e)
+            job['fetch'] = time.time() - startTime
+            images.put((job, image))
+    
+    def _classify(self, images, results):
+        # Classify the images in batches of whatever is ready, up to
+        # batchSize.
+        done = False
+        while not done:
+            batch = []
+            item = images.get()
+            while True:
+                if item is _END:
+                    # Leave any other ends of input for the other threads.
+                    done = True
+                    break
+                batch.append(item)
+                if len(batch) >= self._batchSize:
+                    break
+                try:
+                    item = images.get_nowait()
+                except Queue.Empty:
+                    break
+            jobs = [job for job, image in batch if image is not None]
+            queryImages = [image for job, image in batch
+                           if image is not None]
+            if queryImages:
+                startTime = time.time()
+                try:
+                    labels, similarities = self._classifier.classifyBatch(
+                            queryImages)
+                except Exception as e:
+                    print >> sys.stderr, 'Failed to classify a batch: %s' % e
+                    for job in jobs:
+                        results.put(self._record(
+                                job, None, None, 0.0,
+                                'Failed to classify image'))
+                else:
+                    classifyTime = \
+                            (time.time() - startTime) / len(queryImages)
+                    for job, label, scores in zip(jobs, labels,
+                                                  similarities):
+                        results.put(self._record(job, label, scores,
+                                                 classifyTime))
+            for job, image in batch:
+                if image is None:
+                    results.put(self._record(
+                            job, None, None, 0.0,
+                            'Failed to download or decode image'))
+    
+    def _record(self, job, label, scores, classifyTime, error=None):
+        record = {
+            'source': job['source'],
+            'url': job['url'],
+            'label': label,
+            'scores': scores,
+            'timings': {
+                'search': job['search'],
+                'fetch': job['fetch'],
+                'classify': classifyTime
+            }
+        }
+        if error is not None:
+            record['error'] = error
+        return record
+
+
+def readLocations(manifestPath=None, directoryPath=None):
+    # Return image paths and URLs from a manifest with one per line, and
+    # the image files under a directory. Relative paths in the manifest
+    # are relative to the manifest.
+    locations = []
+    if manifestPath is not None:
+        baseDir = os.path.dirname(os.path.abspath(manifestPath))
+        with open(manifestPath, 'rb') as f:
+            for line in f:
+                location = line.strip()
+                if not location or location.startswith('#'):
+                    continue
+                if not (location.startswith('http://') or
+                        location.startswith('https://')):
+                    location = os.path.join(baseDir, location)
+                locations.append(location)
+    if directoryPath is not None:
+        for dirPath, dirNames, filenames in os.walk(directoryPath):
+            dirNames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    locations.append(os.path.join(dirPath, filename))
+    return locations
+
+def readQueries(path):
+    with open(path, 'rb') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Classify images from searches, manifests, or '
+                        'directories, writing JSON lines.')
+    parser.add_argument('--query', action='append', default=[],
+                        help='image search query; may be repeated')
+    parser.add_argument('--queries',
+                        help='file of image search queries, one per line')
+    parser.add_argument('--results-per-query', type=int, default=50)
+    parser.add_argument('--manifest',
+                        help='file of image paths or URLs, one per line')
+    parser.add_argument('--directory',
+                        help='directory of images to classify')
+    parser.add_argument('--classifier', default='classifier.model',
+                        help='model path')
+    parser.add_argument('--output', default='-',
+                        help='JSON lines output path, or - for stdout')
+    parser.add_argument('--fetch-threads', type=int, default=16)
+    parser.add_argument('--classify-threads', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--reduction', type=int, default=1,
+                        choices=[1, 2, 4, 8],
+                        help='decode images at 1/2, 1/4, or 1/8 size')
+    parser.add_argument('--classification-cache',
+                        help='SQLite file of cached classifications')
+    parser.add_argument('--search-cache',
+                        help='SQLite file of cached search results')
+    args = parser.parse_args()
+    
+    queries = list(args.query)
+    if args.queries is not None:
+        queries += readQueries(args.queries)
+    locations = readLocations(args.manifest, args.directory)
+    if not queries and not locations:
+        parser.error('no queries, manifest, or directory given')
+    
+    classifier = HistogramClassifier()
+    classifier.deserialize(args.classifier)
+    if args.classification_cache is not None:
+        classifier.cache = ClassificationCache(args.classification_cache)
+    searchCache = None
+    if args.search_cache is not None:
+        searchCache = SearchCache(args.search_cache)
+    
+    batch = LuxocatorBatch(classifier, searchCache, args.fetch_threads,
+                           args.classify_threads, args.batch_size,
+                           args.reduction)
+    if args.output == '-':
+        batch.run(queries, locations, sys.stdout, args.results_per_query)
+    else:
+        with open(args.output, 'wb') as output:
+            batch.run(queries, locations, output, args.results_per_query)
+    
+    print >> sys.stderr, \
+        'Classified %d images in %.1f s (%.1f images/s), %d failed' % \
+        (batch.numImages, batch.elapsed, batch.imagesPerSecond,
+         batch.numFailed)
+    
+    if classifier.cache is not None:
+        classifier.cache.close()
+    if searchCache is not None:
+        searchCache.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import numpy # Hint to PyInstaller
 from CVForwardCompat import cv2
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import sys
 
 
@@ -10,6 +12,43 @@ HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9; rv:25.0) Gecko/20100101 Firefox/25.0'
 }
 
+# Flags for decoding images at 1/2, 1/4, or 1/8 size.
+REDUCED_DECODE_FLAGS = {
+    2: getattr(cv2, 'IMREAD_REDUCED_COLOR_2', None),
+    4: getattr(cv2, 'IMREAD_REDUCED_COLOR_4', None),
+    8: getattr(cv2, 'IMREAD_REDUCED_COLOR_8', None)
+}
+
+def _imdecodeSupportsReduction():
+    # OpenCV 2.x lacks the flags, and some 3.x and 4.x builds accept them
+    # in imread but ignore them in imdecode. Try decoding a small JPEG.
+    if REDUCED_DECODE_FLAGS[2] is None:
+        return False
+    _, encoded = cv2.imencode('.jpg', numpy.zeros((16, 16, 3), numpy.uint8))
+    decoded = cv2.imdecode(encoded, REDUCED_DECODE_FLAGS[2])
+    return decoded is not None and decoded.shape[0] == 8
+
+# Where reduced decoding is unsupported, decode at full size and resize.
+IMDECODE_SUPPORTS_REDUCTION = _imdecodeSupportsReduction()
+
+def createSession(poolSize=16, retries=3, backoffFactor=0.5):
+    # Create a session that keeps up to poolSize connections alive per
+    # host and retries failed connections and server errors, waiting
+    # backoffFactor * (2 ^ (retry number - 1)) seconds between retries.
+    retry = Retry(total=retries, backoff_factor=backoffFactor,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=poolSize,
+                          pool_maxsize=poolSize, max_retries=retry)
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# A session shared by all requests, so that connections are reused.
+SESSION = createSession()
+
 def validateResponse(response):
     statusCode = response.status_code
     if statusCode == 200:
@@ -20,17 +59,44 @@ def validateResponse(response):
         (statusCode, url)
     return False
 
-def cvImageFromUrl(url):
-    response = requests.get(url, headers=HEADERS)
+def cvImageFromUrl(url, reduction=1, session=SESSION, timeout=30):
+    # Download and decode an image, optionally at 1/2, 1/4, or 1/8 size.
+    try:
+        response = session.get(url, timeout=timeout)
+    except requests.RequestException as e:
+        print >> sys.stderr, \
+            'Failed to request %s: %s' % (url, e)
+        return None
     if not validateResponse(response):
         return None
-    imageData = numpy.fromstring(response.content, numpy.uint8)
-    image = cv2.imdecode(imageData, cv2.CV_LOAD_IMAGE_COLOR)
+    # Decode from a view of the response's content, rather than a copy.
+    imageData = numpy.frombuffer(response.content, numpy.uint8)
+    image = cvImageFromBuffer(imageData, reduction)
     if image is None:
         print >> sys.stderr, \
             'Failed to decode image from content of %s' % url
     return image
 
+def cvImageFromBuffer(imageData, reduction=1):
+    # Return the decoded image, or None if the data is empty or cannot be
+    # decoded.
+    if len(imageData) == 0:
+        return None
+    try:
+        if reduction == 1:
+            return cv2.imdecode(imageData, cv2.CV_LOAD_IMAGE_COLOR)
+        if IMDECODE_SUPPORTS_REDUCTION:
+            return cv2.imdecode(imageData, REDUCED_DECODE_FLAGS[reduction])
+        image = cv2.imdecode(imageData, cv2.CV_LOAD_IMAGE_COLOR)
+    except cv2.error:
+        return None
+    if image is None:
+        return None
+    h, w = image.shape[:2]
+    size = (max(1, (w + reduction - 1) // reduction),
+            max(1, (h + reduction - 1) // reduction))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
 
 def main():
     image = cvImageFromUrl('http://nummist.com/images/ceiling.gaze.jpg')
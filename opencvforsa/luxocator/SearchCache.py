@@ -0,0 +1,141 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SearchCache(object):
+    
+    # A persistent cache of search responses, keyed by query, custom
+    # parameters, offset, and count. Entries older than ttl seconds are
+    # discarded, and the least recently used entries are evicted to keep
+    # the responses within maxBytes. The cache may be shared by threads.
+    
+    def __init__(self, path, ttl=24*60*60, maxBytes=32*1024*1024):
+        
+        self._ttl = ttl
+        self._maxBytes = maxBytes
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        
+        dirPath = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirPath):
+            os.makedirs(dirPath)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # Write ahead logging avoids syncing the file on every lookup.
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS searches ('
+                'query TEXT, customParams TEXT, offset INTEGER, '
+                'count INTEGER, response TEXT, numBytes INTEGER, '
+                'created REAL, lastUsed REAL, '
+                'PRIMARY KEY (query, customParams, offset, count))')
+        self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS searchesLastUsed '
+                'ON searches (lastUsed)')
+        self._connection.commit()
+        self._numBytes = self._connection.execute(
+                'SELECT TOTAL(numBytes) FROM searches').fetchone()[0]
+    
+    @property
+    def ttl(self):
+        return self._ttl
+    
+    @property
+    def maxBytes(self):
+        return self._maxBytes
+    
+    @property
+    def numBytes(self):
+        return int(self._numBytes)
+    
+    @property
+    def hits(self):
+        return self._hits
+    
+    @property
+    def misses(self):
+        return self._misses
+    
+    @property
+    def evictions(self):
+        return self._evictions
+    
+    def get(self, query, customParams, offset, count):
+        # Return the cached response as parsed JSON, or None if the search
+        # is not cached or its entry has expired.
+        key = (query, customParams, offset, count)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                    'SELECT response, numBytes, created FROM searches '
+                    'WHERE query = ? AND customParams = ? AND offset = ? '
+                    'AND count = ?', key).fetchone()
+            if row is not None and now - row[2] > self._ttl:
+                self._connection.execute(
+                        'DELETE FROM searches WHERE query = ? AND '
+                        'customParams = ? AND offset = ? AND count = ?',
+                        key)
+                self._numBytes -= row[1]
+                self._evictions += 1
+                self._connection.commit()
+                row = None
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._connection.execute(
+                    'UPDATE searches SET lastUsed = ? WHERE query = ? AND '
+                    'customParams = ? AND offset = ? AND count = ?',
+                    (now,) + key)
+            self._connection.commit()
+        return json.loads(row[0])
+    
+    def put(self, query, customParams, offset, count, response):
+        key = (query, customParams, offset, count)
+        text = json.dumps(response)
+        numBytes = len(text)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                    'SELECT numBytes FROM searches WHERE query = ? AND '
+                    'customParams = ? AND offset = ? AND count = ?',
+                    key).fetchone()
+            if row is not None:
+                self._numBytes -= row[0]
+            self._connection.execute(
+                    'INSERT OR REPLACE INTO searches '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    key + (text, numBytes, now, now))
+            self._numBytes += numBytes
+            # Evict the least recently used entries, expired ones first.
+            while self._numBytes > self._maxBytes:
+                row = self._connection.execute(
+                        'SELECT rowid, numBytes FROM searches '
+                        'ORDER BY created > ?, lastUsed LIMIT 1',
+                        (now - self._ttl,)).fetchone()
+                self._connection.execute(
+                        'DELETE FROM searches WHERE rowid = ?', (row[0],))
+                self._numBytes -= row[1]
+                self._evictions += 1
+            self._connection.commit()
+    
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM searches')
+            self._connection.commit()
+            self._numBytes = 0
+    
+    def close(self):
+        with self._lock:
+            self._connection.close()
+    
+    def printStats(self):
+        print 'Search cache: %d hits, %d misses, %d evictions, ' \
+              '%d of %d bytes used' % \
+              (self._hits, self._misses, self._evictions, self._numBytes,
+               self._maxBytes)
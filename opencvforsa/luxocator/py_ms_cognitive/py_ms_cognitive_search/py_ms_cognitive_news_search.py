@@ -30,7 +30,7 @@ class PyMsCognitiveNewsSearch(PyMsCognitiveSearch):
           #'safesearch' : 'Moderate', #optional
         }
         headers = { 'Ocp-Apim-Subscription-Key' : self.api_key }
-        response = requests.get(self.QUERY_URL, params=payload, headers=headers)
+        response = self._get(payload, headers)
         json_results = self.get_json_results(response)
 
         packaged_results = [NewsResult(single_result_json) for single_result_json in json_results["value"]]
@@ -1,14 +1,61 @@
 import requests, requests.utils
-import time, re
+import time, re, random, threading
 import pdb
 
 class PyMsCognitiveException(Exception):
     pass
 
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket rate limiter.
+    Allows 'rate' requests per second on average, in bursts of up to 'burst' requests.
+    '''
+    def __init__(self, rate=3.0, burst=3):
+        self._lock = threading.Lock()
+        self.set_rate(rate, burst)
+        self._paused_until = 0.0
+
+    def set_rate(self, rate, burst=None):
+        ''' Changes the rate and burst size, starting with a full bucket. '''
+        with self._lock:
+            self.rate = float(rate)
+            self.burst = burst if burst is not None else max(1, int(rate))
+            self._tokens = float(self.burst)
+            self._last_time = time.time()
+
+    def acquire(self):
+        ''' Blocks until a request is permitted. '''
+        while True:
+            with self._lock:
+                now = time.time()
+                wait = self._paused_until - now
+                if wait <= 0:
+                    self._tokens = min(self.burst, self._tokens + (now - self._last_time) * self.rate)
+                    self._last_time = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        ''' Holds back all callers for 'seconds', e.g. after the server asks us to retry later. '''
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+            self._tokens = 0.0
+
 class PyMsCognitiveSearch(object):
     """
     Shell class for the individual searches
     """
+    # Shared by all searches, so that together they stay within the API quota.
+    # Adjust with PyMsCognitiveSearch.rate_limiter.set_rate(qps, burst).
+    rate_limiter = TokenBucket()
+    # Retries for throttled (429) or unavailable (503) responses.
+    max_retries = 5
+    backoff_base = 0.5
+    backoff_max = 60.0
+
     def __init__(self, api_key, query, query_url, safe=False):
         self.api_key = api_key
         self.safe = safe
@@ -17,6 +64,36 @@ class PyMsCognitiveSearch(object):
         self.QUERY_URL = query_url
         self.most_recent_json = None
 
+    def _get(self, params, headers):
+        '''
+        Sends a rate-limited GET request to the query url, retrying throttled requests.
+        Waits for the Retry-After header's time if given, otherwise backs off exponentially with jitter.
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            response = requests.get(self.QUERY_URL, params=params, headers=headers)
+            if response.status_code not in [429, 503] or attempt == self.max_retries:
+                return response
+            delay = self._retry_delay(response, attempt)
+            print ("CODE {code}, retrying in {delay:.1f} seconds".format(code=response.status_code, delay=delay))
+            self.rate_limiter.pause(delay)
+
+    def _retry_delay(self, response, attempt):
+        ''' Returns the seconds to wait before retrying a throttled request. '''
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        try:
+            # extract time out seconds from response
+            return int(re.search('in (.+?) seconds', response.json()['message']).group(1)) + 1
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+        # "full jitter" keeps concurrent clients from retrying in lockstep.
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
     def get_json_results(self, response):
         '''
         Parses the request result and returns the JSON object. Handles all errors.
@@ -27,24 +104,13 @@ class PyMsCognitiveSearch(object):
             json_results = response.json()
             if response.status_code in [401, 403]: #401 is invalid key, 403 is out of monthly quota.
                 raise PyMsCognitiveException("CODE {code}: {message}".format(code=response.status_code,message=json_results["message"]) )
-            elif response.status_code in [429]:
-                message = json_results['message']
-                try:
-                    # extract time out seconds from response
-                    timeout = int(re.search('in (.+?) seconds', message).group(1)) + 1
-                    print ("CODE 429, sleeping for {timeout} seconds").format(timeout=str(timeout))
-                    time.sleep(timeout)
-                except (AttributeError, ValueError) as e:
-                    if not self.safe:
-                        raise PyMsCognitiveException("CODE 429. Failed to auto-sleep: {message}".format(code=response.status_code,message=json_results["message"]) )
-                    else:
-                        print ("CODE 429. Failed to auto-sleep: {message}. Trying again in 5 seconds.".format(code=response.status_code,message=json_results["message"]))
-                        time.sleep(5)
+            elif response.status_code in [429]: # still throttled after _get's retries.
+                raise PyMsCognitiveException("CODE 429. Retries exhausted: {message}".format(message=json_results.get("message")) )
         except ValueError as vE:
             if not self.safe:
-                raise PyMsCognitiveException("Request returned with code %s, error msg: %s" % (r.status_code, r.text))
+                raise PyMsCognitiveException("Request returned with code %s, error msg: %s" % (response.status_code, response.text))
             else:
-                print ("[ERROR] Request returned with code %s, error msg: %s. \nContinuing in 5 seconds." % (r.status_code, r.text))
+                print ("[ERROR] Request returned with code %s, error msg: %s. \nContinuing in 5 seconds." % (response.status_code, response.text))
                 time.sleep(5)
         return json_results
 
@@ -63,7 +129,6 @@ class PyMsCognitiveSearch(object):
                 break
             results += more_results
             limit = limit - len(more_results)
-            time.sleep(1)
         return results
 
 class QueryChecker():
@@ -30,7 +30,7 @@ class PyMsCognitiveVideoSearch(PyMsCognitiveSearch):
           #'safesearch' : 'Moderate', #optional
         }
         headers = { 'Ocp-Apim-Subscription-Key' : self.api_key }
-        response = requests.get(self.QUERY_URL, params=payload, headers=headers)
+        response = self._get(payload, headers)
 
         json_results = self.get_json_results(response)
 
@@ -32,7 +32,7 @@ class PyMsCognitiveWebSearch(PyMsCognitiveSearch):
         headers = { 'Ocp-Apim-Subscription-Key' : self.api_key }
         if self.safe:
             QueryChecker.check_web_params(payload, headers)
-        response = requests.get(self.QUERY_URL, params=payload, headers=headers)
+        response = self._get(payload, headers)
         json_results = self.get_json_results(response)
         packaged_results = [WebResult(single_result_json) for single_result_json in json_results["webPages"]["value"]]
         self.current_offset += min(50, limit, len(packaged_results))